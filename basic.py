@@ -0,0 +1,233 @@
+# Microsoft BASIC in ROM at A000-BFFF keeps a program as a linked list of
+#  lines starting at the address in TXTTAB.  Each line is
+#
+#     2 bytes   address of the next line (0 at the end of the program)
+#     2 bytes   line number
+#     n bytes   the text with the keywords replaced by one byte tokens
+#     1 byte    0
+#
+# This class reads the keyword table out of the BASIC ROM so programs can be
+#  tokenized and put straight into memory rather than typed in a character
+#  at a time through the cassette.
+#
+class Basic:
+
+    # The keyword table in the ROM.  Each keyword has the top bit set on its
+    #  last character, the first is token 0x80 and a 0 ends the table.
+    KEYWORD_TABLE = 0xA084
+    FIRST_TOKEN = 0x80
+
+    # Zero page pointers.
+    TXTTAB = 0x79   # Start of the program.
+    VARTAB = 0x7B   # Start of the simple variables, just after the program.
+    ARYTAB = 0x7D   # Start of the arrays.
+    STREND = 0x7F   # End of the arrays.
+    FRETOP = 0x81   # Bottom of the strings, which grow down from MEMSIZ.
+    MEMSIZ = 0x85   # Top of the memory BASIC uses.
+
+    TOKEN_DATA = 0x83
+    TOKEN_REM = 0x8E
+    TOKEN_PRINT = 0x97
+
+    def __init__(self, mmu):
+        self.mmu = mmu
+
+        # Read the keywords out of the ROM.
+        self.keywords = []
+        memory = mmu.memory
+        addr = self.KEYWORD_TABLE
+        while memory[addr] != 0:
+            word = bytearray()
+            while memory[addr] < 0x80:
+                word.append(memory[addr])
+                addr += 1
+            word.append(memory[addr] & 0x7f)
+            addr += 1
+            self.keywords.append(bytes(word))
+
+    def readWord(self, addr):
+        return self.mmu.memory[addr] | (self.mmu.memory[addr+1] << 8)
+
+    def writeWord(self, addr, value):
+        self.mmu.write(addr, value & 0xff)
+        self.mmu.write(addr+1, value >> 8)
+
+    def started(self):
+        """
+        Returns True once BASIC has been cold started and set up its
+        pointers, before that there is nowhere to put a program.
+        """
+        txttab = self.readWord(self.TXTTAB)
+        memsiz = self.readWord(self.MEMSIZ)
+        return 0x200 <= txttab < memsiz <= 0xA000
+
+    def matchKeyword(self, text, i):
+        """
+        Look for a keyword at `text[i]` the way the ROM does: the first
+        keyword in the table that matches wins and spaces inside a keyword
+        are skipped. Returns the token and the index after the keyword, or
+        None if there is no match.
+        """
+        for n, word in enumerate(self.keywords):
+            j = i
+            for c in word:
+                while j < len(text) and text[j] == 0x20:
+                    j += 1
+                if j == len(text) or text[j] != c:
+                    break
+                j += 1
+            else:
+                return self.FIRST_TOKEN + n, j
+        return None
+
+    def tokenize(self, text):
+        """
+        Convert the text of a line, after the line number, to the bytes BASIC
+        stores for it.  The rules follow the ROM: nothing inside quotes, after
+        REM or in a DATA statement is tokenized, ? is PRINT and digits, : and
+        ; are never the start of a keyword.
+        """
+        out = bytearray()
+        data = False
+        i = 0
+        while i < len(text):
+            c = text[i]
+            if c == 0x22:
+                # Copy a quoted string up to the closing quote.
+                end = text.find(b'"', i+1)
+                end = len(text) if end < 0 else end+1
+                out += text[i:end]
+                i = end
+                continue
+            if c == 0x20 or data or 0x30 <= c < 0x3c:
+                out.append(c)
+                i += 1
+                if c == 0x3a:
+                    data = False
+                continue
+            if c == 0x3f:
+                out.append(self.TOKEN_PRINT)
+                i += 1
+                continue
+            match = self.matchKeyword(text, i)
+            if match is None:
+                out.append(c)
+                i += 1
+                continue
+            token, i = match
+            out.append(token)
+            if token == self.TOKEN_REM:
+                # The rest of the line is a comment.
+                out += text[i:]
+                break
+            if token == self.TOKEN_DATA:
+                data = True
+        return bytes(out)
+
+    def parse(self, listing):
+        """
+        Split a program listing into a dictionary of line number to
+        tokenized text. Later lines replace earlier ones with the same
+        number and a number on its own deletes the line, as when typed in.
+        """
+        lines = {}
+        for line in listing.replace(b'\r', b'\n').split(b'\n'):
+            # Read the line number, BASIC skips any spaces in it.
+            number = None
+            i = 0
+            while i < len(line) and (line[i] == 0x20 or 0x30 <= line[i] <= 0x39):
+                if line[i] != 0x20:
+                    number = (number or 0) * 10 + line[i] - 0x30
+                i += 1
+            if number is None:
+                continue
+            text = line[i:]
+            if text:
+                lines[number] = self.tokenize(text)
+            else:
+                lines.pop(number, None)
+        return lines
+
+    def load(self, listing):
+        """
+        Replace the program in memory with the one in the listing (bytes),
+        the same as NEW then typing it in. Returns the number of lines, or
+        None if BASIC is not running or the program doesn't fit.
+        """
+        if not self.started():
+            return None
+        lines = self.parse(listing)
+        addr = self.readWord(self.TXTTAB)
+        size = sum(4 + len(text) + 1 for text in lines.values()) + 2
+        if addr + size > self.readWord(self.MEMSIZ):
+            return None
+        for number in sorted(lines):
+            text = lines[number]
+            link = addr + 4 + len(text) + 1
+            self.writeWord(addr, link)
+            self.writeWord(addr+2, number)
+            for i, b in enumerate(text):
+                self.mmu.write(addr+4+i, b)
+            self.mmu.write(link-1, 0)
+            addr = link
+        self.writeWord(addr, 0)
+
+        # Clear the variables and strings as NEW does.
+        end = addr + 2
+        self.writeWord(self.VARTAB, end)
+        self.writeWord(self.ARYTAB, end)
+        self.writeWord(self.STREND, end)
+        self.writeWord(self.FRETOP, self.readWord(self.MEMSIZ))
+        return len(lines)
+
+    def lines(self):
+        """
+        Yield the line number and tokenized text of each line of the program
+        in memory, following the links from TXTTAB.
+        """
+        memory = self.mmu.memory
+        memsiz = self.readWord(self.MEMSIZ)
+        addr = self.readWord(self.TXTTAB)
+        while addr + 4 <= memsiz:
+            link = self.readWord(addr)
+            # A broken link would send the walk round in circles.
+            if link <= addr or link > memsiz:
+                break
+            end = memory.find(0, addr+4, link)
+            if end < 0:
+                break
+            yield self.readWord(addr+2), bytes(memory[addr+4:end])
+            addr = link
+
+    def detokenize(self, text):
+        """
+        Convert the stored text of a line back into what was typed, the
+        reverse of `tokenize`.
+        """
+        out = bytearray()
+        quoted = data = False
+        for i, c in enumerate(text):
+            if c == 0x22:
+                quoted = not quoted
+            elif not quoted and c == 0x3a:
+                data = False
+            if c < self.FIRST_TOKEN or quoted or data or c - self.FIRST_TOKEN >= len(self.keywords):
+                out.append(c)
+                continue
+            out += self.keywords[c - self.FIRST_TOKEN]
+            if c == self.TOKEN_REM:
+                out += text[i+1:]
+                break
+            if c == self.TOKEN_DATA:
+                data = True
+        return bytes(out)
+
+    def list(self):
+        """
+        Return the program in memory as a listing (bytes) in the same form
+        as the files in the tape folder, or None if BASIC is not running.
+        """
+        if not self.started():
+            return None
+        return b"".join(b"%d %s\r\n" % (number, self.detokenize(text))
+                        for number, text in self.lines())
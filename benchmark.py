@@ -0,0 +1,64 @@
+from argparse import ArgumentParser
+import time
+from machine import Machine
+
+# Measure how fast the 6502 core runs.  The machine is booted into the
+# monitor, C is pressed for a BASIC cold start and the BASIC memory size test
+# and sign on are timed.  The work is a fixed number of emulated CPU cycles
+# since a translated block runs several instructions at once.
+
+
+def measure(path, options, cycles, count=False):
+    """
+    Run the benchmark and return the seconds it took.  With `count` the CPU
+    is single stepped and the number of instructions is returned instead.
+    """
+    machine = Machine(path, **options)
+    cpu = machine.cpu
+    keyboard = machine.keyboard
+
+    # Let the monitor come up, then answer C and RETURN to start BASIC.
+    script = [(100000, ord('C')), (20000, None), (20000, keyboard.KEY_RETURN), (20000, None)]
+    start = time.perf_counter()
+    instructions = 0
+    for n, key in script + [(cycles, None)]:
+        if count:
+            total = 0
+            while total < n:
+                cpu.step()
+                total += cpu.cc
+                instructions += 1
+        else:
+            cpu.run(n)
+        if key is None:
+            keyboard.clearMatrix()
+            keyboard.pressKey(keyboard.KEY_SHIFTLOCK)
+        else:
+            keyboard.pressKey(key)
+    if count:
+        return instructions
+    return time.perf_counter() - start
+
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--filename', help='ROM file', default='cegmon.hex')
+    arg_parser.add_argument('--cycles', help='CPU cycles to run', type=int, default=5000000)
+    args = arg_parser.parse_args()
+
+    modes = [
+        ("partial", {"compiled": False, "translate": False}),
+        ("compiled", {"compiled": True, "translate": False}),
+        ("translate", {"compiled": True, "translate": True}),
+    ]
+    instructions = measure(args.filename, modes[0][1], args.cycles, count=True)
+    base = None
+    for name, options in modes:
+        seconds = measure(args.filename, options, args.cycles)
+        if base is None:
+            base = seconds
+        print("%-10s %10.0f instructions/s %6.2f MHz  x%.2f" % (
+            name, instructions / seconds, args.cycles / seconds / 1e6, base / seconds))
+
+if __name__ == '__main__':
+    main()
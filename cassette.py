@@ -7,6 +7,14 @@
 #
 # This class emulates the Ohio Superboard II ACIA cassette interface..
 #  
+# A tape being loaded is memory mapped rather than read in, so loading
+#  starts straight away however large the file is.  A tape can hold several
+#  BASIC programs one after another, a new one starts wherever the line
+#  numbers go back down.
+#
+import mmap
+import re
+
 class Cassette:
    
     CONTROL_STATUS = 0xF000
@@ -15,14 +23,26 @@ class Cassette:
     RX_READY = 0x01
     TX_READY = 0x02
     
+    # Bytes written to the tape are held in memory and only go to the file
+    # at the end of each line or when this many have built up.
+    SAVE_BUFFER_SIZE = 4096
+    
+    # A BASIC line on the tape: the line number, REM if the line starts
+    # with one, then the rest of the line.
+    TAPE_LINE = re.compile(rb'^[ \0]*(\d+) *(REM)?([^\r\n]*)', re.M)
+    
     def __init__(self):
         
         # The cassette will be virtualized through files.
+        self.load_file = None
+        self.load_filename = None
         self.load_buffer = None
         self.load_buffer_len = 0
         self.load_index = 0
         
         self.save_filename = None
+        self.save_file = None
+        self.save_buffer = bytearray()
        
         # The cassette TX and RX status byte.
         self.acia_status = self.TX_READY
@@ -50,9 +70,28 @@ class Cassette:
             # Control character.
             pass
         elif addr == self.READ_WRITE:
-            if self.acia_status and self.TX_READY > 0 and self.save_filename != None and b > 0:
-                with open(self.save_filename, 'a') as f:
-                    f.write(chr(b))
+            if self.acia_status & self.TX_READY and self.save_file != None and b > 0:
+                self.save_buffer.append(b)
+                if b == 0x0D or len(self.save_buffer) >= self.SAVE_BUFFER_SIZE:
+                    self.flush()
+    
+    def flush(self):
+        
+        # Write out anything buffered for the file being saved.
+        if self.save_file != None and self.save_buffer:
+            self.save_file.write(self.save_buffer)
+            self.save_file.flush()
+            self.save_buffer.clear()
+                
+    def close(self):
+        
+        # Finish the file being saved, called on a load or save and at exit.
+        if self.save_file != None:
+            self.flush()
+            self.save_file.close()
+        self.save_file = None
+        self.save_filename = None
+        self.save_buffer.clear()
     
     def callback(self, addr, value):
         if value != None:
@@ -60,27 +99,113 @@ class Cassette:
         else:
             return self.readByte(addr)
        
+    def read(self, filename):
+        
+        # Return the contents of a file in the tape folder.
+        with open("./TAPEs/"+filename,'rb') as f:
+            return f.read()
+       
     def load(self, filename):
         
-        # If a file name returned read the file into the load buffer and 
+        # If a file name returned map the file into the load buffer and 
         # setup the load index.
         if filename:
-            f = open("./TAPEs/"+filename,'rb')
-            self.load_buffer = f.read()
-            self.load_index = 0
+            self.close()
+            self.eject()
+            self.load_file = open("./TAPEs/"+filename,'rb')
+            self.load_filename = filename
+            try:
+                self.load_buffer = mmap.mmap(self.load_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file can't be mapped.
+                self.load_buffer = b""
             self.load_buffer_len = len(self.load_buffer)
+            self.rewind()
+
+    def eject(self):
+        
+        # Let go of the tape being loaded.
+        if isinstance(self.load_buffer, mmap.mmap):
+            self.load_buffer.close()
+        if self.load_file != None:
+            self.load_file.close()
+        self.load_file = None
+        self.load_filename = None
+        self.load_buffer = None
+        self.load_buffer_len = 0
+        self.load_index = 0
+        self.acia_status = self.TX_READY
+
+    def tell(self):
+        
+        # Return how far through the tape being loaded it is and its length.
+        return self.load_index, self.load_buffer_len
+
+    def rewind(self, position=0):
+        
+        # Start reading the tape again from the beginning or the position.
+        self.load_index = position
+        if self.load_index < self.load_buffer_len:
             self.acia_status = self.RX_READY
-            f.close()
+        else:
+            self.acia_status = self.TX_READY
+
+    @classmethod
+    def title(cls, text):
+        
+        # Return the text of a REM line tidied up to use as a title.
+        return text.strip(b' \0*-=#').decode('ascii', 'replace')
+
+    def programs(self):
+        
+        # Yield the position and title, the first REM line that has some
+        # text, of each program on the tape being loaded.
+        position = None
+        title = ""
+        last = None
+        if self.load_buffer_len:
+            for line in self.TAPE_LINE.finditer(self.load_buffer):
+                number = int(line.group(1))
+                if last == None or number <= last:
+                    if position != None:
+                        yield position, title
+                    position = line.start()
+                    title = ""
+                last = number
+                if line.group(2) and not title:
+                    title = self.title(line.group(3))
+        if position != None:
+            yield position, title
+
+    def seek(self, name):
+        
+        # Move the tape to the first program with the name in its title.
+        # Returns False if there is no such program.
+        for position, title in self.programs():
+            if name.lower() in title.lower():
+                self.rewind(position)
+                return True
+        return False
+
+    def write(self, filename, data):
+        
+        # Write a whole file in one go, there is no need to capture the
+        # output of LIST.
+        self.close()
+        with open(filename,'wb') as f:
+            f.write(data)
 
     def save(self, filename):
         
         if filename != "":
             
+            # Finish any earlier save.
+            self.close()
+            
             # Remember the filename and enable the TX "buffer".
             self.save_filename = filename
             self.acia_status = self.TX_READY
 
-            # Create an empty file.
-            f = open(self.save_filename,'wb')
-            f.close()
+            # Create an empty file and keep it open for the output.
+            self.save_file = open(self.save_filename,'wb')
             
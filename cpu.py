@@ -1,11 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import array
 import math
 import functools
 
 
 class Registers:
     """ An object to hold the CPU registers. """
+    __slots__ = ('a', 'x', 'y', 's', 'pc', 'p')
+
+    # Bits of the flag register P.
+    flagBit = {
+        'N': 128,   # N - Negative
+        'V': 64,    # V - Overflow
+        'B': 16,    # B - Break Command
+        'D': 8,     # D - Decimal Mode
+        'I': 4,     # I - IRQ Disable
+        'Z': 2,     # Z - Zero
+        'C': 1      # C - Carry
+    }
+
+    # The N and Z bits of P for each byte value.
+    NZ = bytes((v & 0x80) | (0 if v else 2) for v in range(256))
+
+    # The N, Z and C bits of P for a 9 bit result, where bit 8 is the carry.
+    NZC = bytes((v & 0x80) | (0 if v & 0xff else 2) | (v >> 8) for v in range(512))
+
     def __init__(self, pc=0):
         self.reset(pc)
 
@@ -15,18 +35,9 @@ class Registers:
         self.y = 0          # General Purpose Y
         self.s = 0xff       # Stack Pointer
         self.pc = pc        # Program Counter
-
-        self.flagBit = {
-            'N': 128,   # N - Negative
-            'V': 64,    # V - Overflow
-            'B': 16,    # B - Break Command
-            'D': 8,     # D - Decimal Mode
-            'I': 4,     # I - IRQ Disable
-            'Z': 2,     # Z - Zero
-            'C': 1      # C - Carry
-        }
         self.p = 0b00100100  # Flag Pointer - N|V|1|B|D|I|Z|C
 
+    # The flags can also be accessed by name.
     def getFlag(self, flag):
         return bool(self.p & self.flagBit[flag])
 
@@ -47,8 +58,7 @@ class Registers:
         The criteria for Z and N flags are standard.  Z gets set if the
         value is zero and N gets set to the same value as bit 7 of the value.
         """
-        self.setFlag('Z', v == 0)
-        self.setFlag('N', v & 0x80)
+        self.p = (self.p & 0x7d) | self.NZ[v]
 
     def __repr__(self):
         return "A: %02x X: %02x Y: %02x S: %02x PC: %04x P: %s" % (
@@ -58,7 +68,8 @@ class Registers:
 
 class CPU:
 
-    def __init__(self, mmu=None, pc=None, stack_page=0x1, magic=0xee):
+    def __init__(self, mmu=None, pc=None, stack_page=0x1, magic=0xee, compiled=False,
+                 translate=False):
         """
         Parameters
         ----------
@@ -69,16 +80,40 @@ class CPU:
             stack page may be elsewhere.
         magic: A value needed for the illegal opcodes, XAA.  This value differs
             between different versions, even of the same CPU.  The default is 0xee.
+        compiled: If True build a specialised Python function for each opcode
+            with the addressing mode and operation fused together (see
+            `_compile_ops`) instead of the generic partial based dispatch.
+        translate: If True straight line runs of code are translated into a
+            single Python function the first time they are executed and
+            cached by their start address (see `_translate`).
         """
         self.mmu = mmu
         self.r = Registers()
         # Hold the number of CPU cycles used during the last call to `self.step()`
+        # or `self.run()`.
         self.cc = 0
+        # The total number of CPU cycles run.
+        self.cycles = 0
         # Which page the stack is in.  0x1 means that the stack is from
         # 0x100-0x1ff.  In the 6502 this is always true but it's different
         # for other 65* varients.
         self.stack_page = stack_page
         self.magic = magic
+        self.compiled = compiled
+
+        # Translated blocks of code keyed by start address.  False marks an
+        # address that should not be translated.
+        self.translate = translate
+        self.blocks = {}
+        # For blocks in RAM, the (start, end) of each block and the blocks
+        # built from each address, so writes can invalidate them.
+        self.block_span = {}
+        self.block_owners = {}
+        self.block_misses = {}
+        # Set when a block is invalidated so a running RAM block stops.
+        self.stale = False
+        if translate:
+            self.mmu.watcher = self._invalidate
 
         if pc:
             self.r.pc = pc
@@ -90,14 +125,54 @@ class CPU:
 
     def reset(self):
         self.r.reset()
+        self.flushBlocks()
         self.mmu.reset()
 
         self.running = True
 
     def step(self):
         self.cc = 0
+        if self.translate:
+            block = self.blocks.get(self.r.pc)
+            if block is None:
+                block = self._translate(self.r.pc)
+            if block:
+                block()
+                self.cycles += self.cc
+                return
         opcode = self.nextByte()
         self.ops[opcode]()
+        self.cycles += self.cc
+
+    def run(self, cycles):
+        """
+        Run instructions until `cycles` CPU cycles have been used.  Returns the
+        number of cycles actually used, which can be over the budget by the
+        length of the last instruction, or block when translating.
+        """
+        self.cc = 0
+        r = self.r
+        ops = self.ops
+        read = self.mmu.read
+        if self.translate:
+            blocks = self.blocks
+            while self.cc < cycles:
+                block = blocks.get(r.pc)
+                if block is None:
+                    block = self._translate(r.pc)
+                if block:
+                    block()
+                else:
+                    pc = r.pc
+                    r.pc = pc + 1
+                    ops[read(pc)]()
+        else:
+            while self.cc < cycles:
+                pc = r.pc
+                r.pc = pc + 1
+                ops[read(pc)]()
+        self.cycles += self.cc
+        return self.cc
 
     def execute(self, instruction):
         """
@@ -167,20 +242,10 @@ class CPU:
         return self.nextWord()
 
     def ax_a(self):
-        o = self.nextWord()
-        a = o + self.r.x
-        if math.floor(o/0xff) != math.floor(a/0xff):
-            self.cc += 1
-
-        return a & 0xffff
+        return (self.nextWord() + self.r.x) & 0xffff
 
     def ay_a(self):
-        o = self.nextWord()
-        a = o + self.r.y
-        if math.floor(o/0xff) != math.floor(a/0xff):
-            self.cc += 1
-
-        return a & 0xffff
+        return (self.nextWord() + self.r.y) & 0xffff
 
     def i_a(self):
         """Only used by indirect JMP"""
@@ -200,13 +265,22 @@ class CPU:
 
     def iy_a(self):
         i = self.nextByte()
-        o = (self.mmu.read((i + 1) & 0xff) << 8) + self.mmu.read(i)
-        a = o + self.r.y
+        return (self.iy_base(i) + self.r.y) & 0xffff
 
-        if math.floor(o/0xff) != math.floor(a/0xff):
+    def iy_base(self, i):
+        return (self.mmu.read((i + 1) & 0xff) << 8) + self.mmu.read(i)
+
+    def indexed(self, o, a):
+        """
+        Read the value at the indexed address `a` from the base address `o`.
+        Reads take an extra cycle when the indexing crosses a page.  Writes
+        and read-modify-write instructions always take the longer time, which
+        is already in their base cycle count.
+        """
+        if (o ^ a) & 0xff00:
             self.cc += 1
 
-        return a & 0xffff
+        return self.mmu.read(a & 0xffff)
 
     # Return values based on the addressing mode
     def im(self):
@@ -225,10 +299,12 @@ class CPU:
         return self.mmu.read(self.a_a())
 
     def ax(self):
-        return self.mmu.read(self.ax_a())
+        o = self.nextWord()
+        return self.indexed(o, o + self.r.x)
 
     def ay(self):
-        return self.mmu.read(self.ay_a())
+        o = self.nextWord()
+        return self.indexed(o, o + self.r.y)
 
     def i(self):
         return self.mmu.read(self.i_a())
@@ -237,7 +313,8 @@ class CPU:
         return self.mmu.read(self.ix_a())
 
     def iy(self):
-        return self.mmu.read(self.iy_a())
+        o = self.iy_base(self.nextByte())
+        return self.indexed(o, o + self.r.y)
 
     # Operators
     # All the operations.  For each operation have the name of the operation,
@@ -586,6 +663,17 @@ class CPU:
 
     def _create_ops(self):
 
+        # Map each opcode to its entry in the _ops table for translation.
+        self._decode = [None]*0x100
+        for op, atype, addrs in self._ops:
+            for a, cc, opcode, target in addrs:
+                for o in opcode:
+                    self._decode[o] = (op, atype, a, cc, target)
+
+        if self.compiled:
+            self._compile_ops()
+            return
+
         def f(self, op_f, a_f, cc):
             op_f(a_f())
             self.cc += cc
@@ -611,24 +699,457 @@ class CPU:
                         raise Exception("Opcode %s already defined" % hex(o))
                     self.ops[o] = fp
 
-    def ADC(self, v2):
-        v1 = self.r.a
+    # Source used by `_compile_ops` to build the fused opcode handlers.  Each
+    # addressing mode leaves the effective address in `a`, the value modes
+    # then read it into `v`.  `{PAGE}` marks where the value modes count the
+    # extra cycle for an indexed read that crosses a page.  Memory is read
+    # and written straight through the MMU's page tables, `readers[a >> 8](a)`
+    # and `writers[a >> 8](a, v)`, and the zero page and stack through their
+    # own page.
+    _addr_source = {
+        "im": ["a = r.pc", "r.pc = a + 1"],
+        "z":  ["pc = r.pc", "a = readers[pc >> 8](pc)", "r.pc = pc + 1"],
+        "zx": ["pc = r.pc", "a = (readers[pc >> 8](pc) + r.x) & 0xff", "r.pc = pc + 1"],
+        "zy": ["pc = r.pc", "a = (readers[pc >> 8](pc) + r.y) & 0xff", "r.pc = pc + 1"],
+        "a":  ["pc = r.pc", "a = readers[pc >> 8](pc) + (readers[(pc + 1) >> 8](pc + 1) << 8)", "r.pc = pc + 2"],
+        "ax": ["pc = r.pc", "o = readers[pc >> 8](pc) + (readers[(pc + 1) >> 8](pc + 1) << 8)", "r.pc = pc + 2",
+               "a = o + r.x", "{PAGE}", "a &= 0xffff"],
+        "ay": ["pc = r.pc", "o = readers[pc >> 8](pc) + (readers[(pc + 1) >> 8](pc + 1) << 8)", "r.pc = pc + 2",
+               "a = o + r.y", "{PAGE}", "a &= 0xffff"],
+        "i":  ["pc = r.pc", "i = readers[pc >> 8](pc) + (readers[(pc + 1) >> 8](pc + 1) << 8)", "r.pc = pc + 2",
+               "j = i - 0xff if i & 0xff == 0xff else i + 1",
+               "a = ((readers[j >> 8](j) << 8) + readers[i >> 8](i)) & 0xffff"],
+        "ix": ["pc = r.pc", "i = (readers[pc >> 8](pc) + r.x) & 0xff", "r.pc = pc + 1",
+               "a = ((readers[0]((i + 1) & 0xff) << 8) + readers[0](i)) & 0xffff"],
+        "iy": ["pc = r.pc", "i = readers[pc >> 8](pc)", "r.pc = pc + 1",
+               "o = (readers[0]((i + 1) & 0xff) << 8) + readers[0](i)",
+               "a = o + r.y", "{PAGE}", "a &= 0xffff"],
+    }
+
+    _PAGE = ["if (o ^ a) & 0xff00:", "    cpu.cc += 1"]
+
+    # Operations written out inline.  `{ZN}` expands to the new value of P
+    # with Z and N set from `n`.  Operations which are not listed here call
+    # the regular method with the decoded operand.
+    _op_source = {
+        "ADC": ["if r.p & 8:",
+                "    cpu.ADC(v)",
+                "else:",
+                "    s = r.a",
+                "    t = s + v + (r.p & 1)",
+                "    r.a = t & 0xff",
+                "    r.p = (r.p & 0x3c) | NZC[t] | ((~(s ^ v) & (s ^ t) & 0x80) >> 1)"],
+        "SBC": ["if r.p & 8:",
+                "    cpu.SBC(v)",
+                "else:",
+                "    s = r.a",
+                "    t = s - v - 1 + (r.p & 1)",
+                "    r.a = t & 0xff",
+                "    r.p = (r.p & 0x3c) | NZC[t + 0x100] | (((s ^ v) & (s ^ t) & 0x80) >> 1)"],
+        "AND": ["n = r.a & v", "r.a = n", "r.p = {ZN}"],
+        "ORA": ["n = r.a | v", "r.a = n", "r.p = {ZN}"],
+        "EOR": ["n = r.a ^ v", "r.a = n", "r.p = {ZN}"],
+        "BIT": ["r.p = (r.p & 0x3d) | (v & 0xc0) | (0 if r.a & v else 2)"],
+        "CMP": ["r.p = (r.p & 0x7c) | NZC[r.a - v + 0x100]"],
+        "CPX": ["r.p = (r.p & 0x7c) | NZC[r.x - v + 0x100]"],
+        "CPY": ["r.p = (r.p & 0x7c) | NZC[r.y - v + 0x100]"],
+        "LDA": ["n = v", "r.a = n", "r.p = {ZN}"],
+        "LDX": ["n = v", "r.x = n", "r.p = {ZN}"],
+        "LDY": ["n = v", "r.y = n", "r.p = {ZN}"],
+        "LAX": ["n = v", "r.a = r.x = n", "r.p = {ZN}"],
+        "DEC": ["n = (readers[a >> 8](a) - 1) & 0xff", "writers[a >> 8](a, n)", "r.p = {ZN}"],
+        "INC": ["n = (readers[a >> 8](a) + 1) & 0xff", "writers[a >> 8](a, n)", "r.p = {ZN}"],
+        "DEX": ["n = (r.x - 1) & 0xff", "r.x = n", "r.p = {ZN}"],
+        "DEY": ["n = (r.y - 1) & 0xff", "r.y = n", "r.p = {ZN}"],
+        "INX": ["n = (r.x + 1) & 0xff", "r.x = n", "r.p = {ZN}"],
+        "INY": ["n = (r.y + 1) & 0xff", "r.y = n", "r.p = {ZN}"],
+        "STA": ["writers[a >> 8](a, r.a)"],
+        "STX": ["writers[a >> 8](a, r.x)"],
+        "STY": ["writers[a >> 8](a, r.y)"],
+        "JMP": ["r.pc = a"],
+        "JSR": ["t = r.pc - 1",
+                "writers[stack >> 8](stack + r.s, t >> 8)",
+                "r.s = (r.s - 1) & 0xff",
+                "writers[stack >> 8](stack + r.s, t & 0xff)",
+                "r.s = (r.s - 1) & 0xff",
+                "r.pc = a"],
+        "RTS": ["s = (r.s + 1) & 0xff",
+                "t = readers[stack >> 8](stack + s)",
+                "s = (s + 1) & 0xff",
+                "r.s = s",
+                "r.pc = (t + (readers[stack >> 8](stack + s) << 8) + 1) & 0xffff"],
+        "NOP": [],
+        "KIL": ["cpu.running = False"],
+    }
+
+    _ZN = "(r.p & 0x7d) | NZ[n]"
+
+    def _target_source(self, op, target):
+        """
+        Return the inline source for the operations whose operand is fixed
+        by the `_ops` table rather than decoded from memory, or None if the
+        regular method should be called.
+        """
+        if op in ("ASL", "LSR", "ROL", "ROR") and target == "a":
+            return {
+                "ASL": ["t = r.a << 1", "r.a = t & 0xff", "r.p = (r.p & 0x7c) | NZC[t]"],
+                "ROL": ["t = (r.a << 1) | (r.p & 1)", "r.a = t & 0xff",
+                        "r.p = (r.p & 0x7c) | NZC[t]"],
+                "LSR": ["t = r.a", "n = t >> 1", "r.a = n",
+                        "r.p = (r.p & 0x7c) | (t & 1) | NZ[n]"],
+                "ROR": ["t = r.a", "n = (t >> 1) | ((r.p & 1) << 7)", "r.a = n",
+                        "r.p = (r.p & 0x7c) | (t & 1) | NZ[n]"],
+            }[op]
+        if op == "B":
+            flag, state = target
+            test = "r.p & %d" % self.r.flagBit[flag]
+            if not state:
+                test = "not " + test
+            return ["pc = r.pc",
+                    "d = readers[pc >> 8](pc)",
+                    "pc += 1",
+                    "if %s:" % test,
+                    "    o = pc",
+                    "    pc += (d & 0x7f) - (d & 0x80)",
+                    "    cpu.cc += 2 if (o ^ pc) & 0xff00 else 1",
+                    "r.pc = pc"]
+        if op == "SE":
+            return ["r.p |= %d" % self.r.flagBit[target]]
+        if op == "CL":
+            return ["r.p &= %d" % (255 - self.r.flagBit[target])]
+        if op == "T":
+            s, d = target
+            if d == "s":
+                return ["r.s = r.%s" % s]
+            return ["n = r.%s" % s, "r.%s = n" % d, "r.p = {ZN}"]
+        if op == "P":
+            action, reg = target
+            if action == "PH":
+                return ["writers[stack >> 8](stack + r.s, r.%s)" % reg, "r.s = (r.s - 1) & 0xff"]
+            pull = ["s = (r.s + 1) & 0xff", "n = readers[stack >> 8](stack + s)", "r.s = s"]
+            if reg == "a":
+                return pull + ["r.a = n", "r.p = {ZN}"]
+            return pull + ["r.p = n | 0b00100000"]
+        if op in ("DEX", "DEY", "INX", "INY", "RTS", "NOP", "KIL"):
+            return self._op_source[op]
+        return None
+
+    def _operation_source(self, op, atype, target):
+        """
+        Return the lines of Python for the operation itself, with the operand
+        already decoded into `v` or `a`.
+        """
+        if target:
+            body = self._target_source(op, target)
+            if body is None:
+                body = ["cpu.%s(%r)" % (op, target)]
+        elif op in self._op_source:
+            body = self._op_source[op]
+        elif op in ("ASL", "LSR", "ROL", "ROR"):
+            body = {
+                "ASL": ["t = readers[a >> 8](a) << 1", "writers[a >> 8](a, t & 0xff)",
+                        "r.p = (r.p & 0x7c) | NZC[t]"],
+                "ROL": ["t = (readers[a >> 8](a) << 1) | (r.p & 1)", "writers[a >> 8](a, t & 0xff)",
+                        "r.p = (r.p & 0x7c) | NZC[t]"],
+                "LSR": ["t = readers[a >> 8](a)", "n = t >> 1", "writers[a >> 8](a, n)",
+                        "r.p = (r.p & 0x7c) | (t & 1) | NZ[n]"],
+                "ROR": ["t = readers[a >> 8](a)", "n = (t >> 1) | ((r.p & 1) << 7)",
+                        "writers[a >> 8](a, n)", "r.p = (r.p & 0x7c) | (t & 1) | NZ[n]"],
+            }[op]
+        else:
+            body = ["cpu.%s(%s)" % (op, "v" if atype == "v" else "a")]
+        return [line.replace("{ZN}", self._ZN) for line in body]
+
+    def _opcode_source(self, op, atype, mode, target):
+        """
+        Return the lines of Python that execute one instruction of `op` in
+        addressing `mode`, not counting the fetch of the opcode itself.
+        """
+        lines = []
+        if not target:
+            for line in self._addr_source[mode]:
+                if line != "{PAGE}":
+                    lines.append(line)
+                elif atype == "v":
+                    lines += self._PAGE
+            if atype == "v":
+                lines.append("v = readers[a >> 8](a)")
+        return lines + self._operation_source(op, atype, target)
+
+    # The compiled handler factory is shared by every CPU instance, only the
+    # closure variables differ.
+    _compiled_factory = None
+
+    def _compile_ops(self):
+        """
+        Build `self.ops` from the `_ops` table as one specialised function per
+        opcode.  The addressing mode, the operation and the flag updates are
+        generated as straight line Python so an instruction costs a single
+        call rather than the chain of partials and methods used by
+        `_create_ops`.
+        """
+        cls = type(self)
+        if cls._compiled_factory is None:
+            names = [None]*0x100
+            src = ["def factory(cpu, r, readers, writers, stack, NZ, NZC):"]
+            for op, atype, addrs in self._ops:
+                for mode, cc, opcodes, target in addrs:
+                    body = self._opcode_source(op, atype, mode, target)
+                    for o in opcodes:
+                        if names[o]:
+                            raise Exception("Opcode %s already defined" % hex(o))
+                        names[o] = "op_%02x" % o
+                        src.append("    def %s():" % names[o])
+                        src.extend("        " + line for line in body)
+                        if cc:
+                            src.append("        cpu.cc += %d" % cc)
+                        else:
+                            src.append("        pass")
+            src.append("    return [%s]" % ", ".join(names))
+            namespace = {}
+            exec(compile("\n".join(src), "<6502 ops>", "exec"), namespace)
+            cls._compiled_factory = namespace["factory"]
+
+        self.ops = cls._compiled_factory(self, self.r, self.mmu.readers, self.mmu.writers,
+                                         self.stack_page*0x100, self.r.NZ, self.r.NZC)
+
+    # Length in bytes of the instructions for each addressing mode.
+    _mode_length = {
+        "im": 2, "z": 2, "zx": 2, "zy": 2, "ix": 2, "iy": 2,
+        "a": 3, "ax": 3, "ay": 3, "i": 3
+    }
+
+    # Operations that end a translated block.
+    _block_end = ("B", "JMP", "JSR", "RTS", "RTI", "BRK")
 
-        if self.r.getFlag('D'):  # decimal mode
-            d1 = self.fromBCD(v1)
-            d2 = self.fromBCD(v2)
-            r = d1 + d2 + self.r.getFlag('C')
-            self.r.a = self.toBCD(r % 100)
+    # Longest run of instructions translated into one block.
+    MAX_BLOCK = 32
 
-            self.r.setFlag('C', r > 99)
+    # Number of times a block of RAM code may be overwritten before that
+    # address is left to the single step handlers.
+    MAX_BLOCK_MISSES = 4
+
+    def _const_addr_source(self, mode, atype, lo, hi):
+        """
+        Return the lines that decode the operand of an instruction whose
+        operand bytes, `lo` and `hi`, are known when it is translated.
+        """
+        w = (hi << 8) + lo
+        if mode == "im":
+            return ["v = %d" % lo]
+        if mode == "z":
+            lines = ["a = %d" % lo]
+        elif mode in ("zx", "zy"):
+            lines = ["a = (%d + r.%s) & 0xff" % (lo, mode[1])]
+        elif mode == "a":
+            lines = ["a = %d" % w]
+        elif mode in ("ax", "ay"):
+            lines = ["a = %d + r.%s" % (w, mode[1])]
+            if atype == "v":
+                lines += ["if (a ^ %d) & 0xff00:" % w, "    cpu.cc += 1"]
+            lines.append("a &= 0xffff")
+        elif mode == "i":
+            j = w - 0xff if lo == 0xff else w + 1
+            lines = ["a = ((readers[%d](%d) << 8) + readers[%d](%d)) & 0xffff"
+                     % (j >> 8, j, w >> 8, w)]
+        elif mode == "ix":
+            lines = ["i = (%d + r.x) & 0xff" % lo,
+                     "a = ((readers[0]((i + 1) & 0xff) << 8) + readers[0](i)) & 0xffff"]
         else:
-            r = v1 + v2 + self.r.getFlag('C')
-            self.r.a = r & 0xff
+            lines = ["o = (readers[0](%d) << 8) + readers[0](%d)" % ((lo + 1) & 0xff, lo),
+                     "a = o + r.y"]
+            if atype == "v":
+                lines += self._PAGE
+            lines.append("a &= 0xffff")
+        if atype == "v":
+            lines.append("v = readers[a >> 8](a)")
+        return lines
+
+    def _translate(self, start):
+        """
+        Translate the straight line run of instructions at `start`, up to and
+        including the first branch, jump or return, into one function and
+        cache it.  Returns the function, or False if the code at `start`
+        cannot be translated.
+        """
+        memmap = self.mmu.memmap
+        memory = self.mmu.memory
+
+        # Only ROM and plain RAM hold code that can be translated.
+        rom = memmap[start] == 1
+        if not rom and memmap[start] not in (0, 2):
+            self.blocks[start] = False
+            return False
+
+        def same_kind(addr):
+            if addr > 0xffff:
+                return False
+            return memmap[addr] == 1 if rom else memmap[addr] in (0, 2)
+
+        src = ["def block():"]
+        pc = start
+        count = 0
+        cycles = 0
+        ends = False
+        while count < self.MAX_BLOCK and not ends and same_kind(pc):
+            op, atype, mode, cc, target = self._decode[memory[pc]]
+            length = 1 if target else self._mode_length[mode]
+            if op == "B":
+                length = 2
+            if not all(same_kind(pc + i) for i in range(length)):
+                break
+            lo = memory[pc + 1] if length > 1 else 0
+            hi = memory[pc + 2] if length > 2 else 0
+            end = pc + length
+            ends = op in self._block_end
+            cycles += cc
+
+            if op == "B":
+                flag, state = target
+                test = "r.p & %d" % self.r.flagBit[flag]
+                if not state:
+                    test = "not " + test
+                dest = end + self.fromTwosCom(lo)
+                lines = ["cpu.cc += %d" % cycles,
+                         "if %s:" % test,
+                         "    r.pc = %d" % dest,
+                         "    cpu.cc += %d" % (2 if (end ^ dest) & 0xff00 else 1),
+                         "else:",
+                         "    r.pc = %d" % end]
+                cycles = 0
+            else:
+                # The operand is folded into the code as a constant.
+                lines = [] if target else self._const_addr_source(mode, atype, lo, hi)
+                body = self._operation_source(op, atype, target)
+                if op == "JSR" or any("cpu.%s(" % op in line for line in body):
+                    lines.append("r.pc = %d" % end)
+                lines += body
+                if ends:
+                    lines.insert(0, "cpu.cc += %d" % cycles)
+                    cycles = 0
+                elif not rom and atype == "a":
+                    # Stop if this instruction overwrote translated code.
+                    lines += ["if cpu.stale:",
+                              "    cpu.stale = False",
+                              "    r.pc = %d" % end,
+                              "    cpu.cc += %d" % cycles,
+                              "    return"]
+            src.extend("    " + line for line in lines)
+            pc = end
+            count += 1
+
+        if count == 0:
+            self.blocks[start] = False
+            return False
+        if not ends:
+            src.append("    r.pc = %d" % pc)
+            src.append("    cpu.cc += %d" % cycles)
+
+        namespace = self._block_globals()
+        exec(compile("\n".join(src), "<6502 block %04x>" % start, "exec"), namespace)
+        block = namespace["block"]
+        self.blocks[start] = block
+
+        # Remember which RAM bytes the block was built from.
+        if not rom:
+            self.block_span[start] = (start, pc)
+            for addr in range(start, pc):
+                self.block_owners.setdefault(addr, []).append(start)
+            self.mmu.watch(start, pc - start)
+        return block
+
+    def _block_globals(self):
+        if self._globals is None:
+            self._globals = {
+                "cpu": self, "r": self.r, "readers": self.mmu.readers,
+                "writers": self.mmu.writers, "stack": self.stack_page*0x100,
+                "NZ": self.r.NZ, "NZC": self.r.NZC
+            }
+        return dict(self._globals)
+
+    _globals = None
+
+    def _invalidate(self, addr):
+        """
+        Called by the MMU before a byte of RAM that translated code was
+        built from is written.  Drops every block built from it.
+        """
+        for start in self.block_owners.pop(addr, ()):
+            if start not in self.block_span:
+                continue
+            first, end = self.block_span.pop(start)
+            del self.blocks[start]
+            misses = self.block_misses.get(start, 0) + 1
+            self.block_misses[start] = misses
+            if misses >= self.MAX_BLOCK_MISSES:
+                # Self modifying code, stop translating it.
+                self.blocks[start] = False
+            for i in range(first, end):
+                owners = self.block_owners.get(i)
+                if owners is not None and start in owners:
+                    owners.remove(start)
+                    if not owners:
+                        del self.block_owners[i]
+                if i not in self.block_owners:
+                    self.mmu.unwatch(i, 1)
+        self.mmu.unwatch(addr, 1)
+        self.stale = True
+
+    def flushBlocks(self):
+        """
+        Forget every translated block.
+        """
+        for start, (first, end) in self.block_span.items():
+            self.mmu.unwatch(first, end - first)
+        self.blocks = {}
+        self.block_span = {}
+        self.block_owners = {}
+        self.block_misses = {}
+
+    # Results of the decimal mode ADC and SBC, built the first time decimal
+    # mode is used.  Indexed by C << 16 | A << 8 | operand, each entry holds
+    # the new A in the low byte and the C, Z, N and V bits of P in the high
+    # byte.
+    decimal_adc = None
+    decimal_sbc = None
+
+    def _buildDecimalTables(self):
+        dec = [self.fromBCD(v) for v in range(256)]
+        bcd = [self.toBCD(v) for v in range(100)]
+        NZ = self.r.NZ
+
+        def adc(c, v1, v2):
+            r = dec[v1] + dec[v2] + c
+            a = bcd[r % 100]
+            return a | ((r > 99) | NZ[a] | (((~(v1 ^ v2)) & (v1 ^ r) & 0x80) >> 1)) << 8
+
+        def sbc(c, v1, v2):
+            r = dec[v1] - dec[v2] - 1 + c
+            a = bcd[r % 100]
+            return a | ((r >= 0) | NZ[a] | (((v1 ^ v2) & (v1 ^ r) & 0x80) >> 1)) << 8
+
+        inputs = [(c, v1, v2) for c in (0, 1) for v1 in range(256) for v2 in range(256)]
+        CPU.decimal_adc = array.array('H', [adc(*i) for i in inputs])
+        CPU.decimal_sbc = array.array('H', [sbc(*i) for i in inputs])
+
+    def ADC(self, v2):
+        v1 = self.r.a
+        p = self.r.p
 
-            self.r.setFlag('C', r > 0xff)
+        if p & 0x08:  # decimal mode
+            if self.decimal_adc is None:
+                self._buildDecimalTables()
+            e = self.decimal_adc[(p & 0x01) << 16 | v1 << 8 | v2]
+            self.r.a = e & 0xff
+            self.r.p = (p & 0x3c) | (e >> 8)
+            return
 
-        self.r.ZN(self.r.a)
-        self.r.setFlag('V', ((~(v1 ^ v2)) & (v1 ^ r) & 0x80))
+        r = v1 + v2 + (p & 0x01)
+        self.r.a = r & 0xff
+
+        # C, Z, N and V.
+        self.r.p = ((p & 0x3c) | (r > 0xff) | self.r.NZ[self.r.a]
+                    | (((~(v1 ^ v2)) & (v1 ^ r) & 0x80) >> 1))
 
     def AND(self, v):
         self.r.a = (self.r.a & v) & 0xff
@@ -642,13 +1163,11 @@ class CPU:
             v = self.mmu.read(a) << 1
             self.mmu.write(a, v)
 
-        self.r.setFlag('C', v > 0xff)
-        self.r.ZN(v & 0xff)
+        self.r.p = (self.r.p & 0x7c) | self.r.NZC[v]
 
     def BIT(self, v):
-        self.r.setFlag('Z', self.r.a & v == 0)
-        self.r.setFlag('N', v & 0x80)
-        self.r.setFlag('V', v & 0x40)
+        # N and V are copied from the value, Z from the AND with A.
+        self.r.p = (self.r.p & 0x3d) | (v & 0xc0) | (0 if self.r.a & v else 2)
 
     def B(self, v):
         """
@@ -656,26 +1175,25 @@ class CPU:
         will call B(('C', False)).
         """
         d = self.im()
-        if self.r.getFlag(v[0]) is v[1]:
+        if (self.r.p & self.r.flagBit[v[0]] != 0) == v[1]:
             o = self.r.pc
             self.r.pc += self.fromTwosCom(d)
-            if math.floor(o/0xff) == math.floor(self.r.pc/0xff):
-                self.cc += 1
-            else:
+            # A taken branch costs a cycle, two if it crosses a page.
+            if (o ^ self.r.pc) & 0xff00:
                 self.cc += 2
+            else:
+                self.cc += 1
 
     def BRK(self, _):
-        self.r.setFlag('B')
+        self.r.p |= 0x10
         self.stackPushWord(self.r.pc+1)
         self.stackPush(self.r.p)
-        self.r.setFlag('I')
+        self.r.p |= 0x04
         self.r.pc = self.interruptAddress('BRK')
 
     def CP(self, r, v):
-        o = (r-v) & 0xff
-        self.r.setFlag('Z', o == 0)
-        self.r.setFlag('C', v <= r)
-        self.r.setFlag('N', o & 0x80)
+        # The carry is set when v <= r, that is when r - v + 0x100 > 0xff.
+        self.r.p = (self.r.p & 0x7c) | self.r.NZC[r - v + 0x100]
 
     def CMP(self, v):
         self.CP(self.r.a, v)
@@ -706,11 +1224,11 @@ class CPU:
     """Flag Instructions."""
     def SE(self, v):
         """Set the flag to True."""
-        self.r.setFlag(v)
+        self.r.p |= self.r.flagBit[v]
 
     def CL(self, v):
         """Clear the flag to False."""
-        self.r.clearFlag(v)
+        self.r.p &= 255 - self.r.flagBit[v]
 
     def INC(self, a):
         v = (self.mmu.read(a)+1) & 0xff
@@ -746,15 +1264,14 @@ class CPU:
 
     def LSR(self, a):
         if a == 'a':
-            self.r.setFlag('C', self.r.a & 0x01)
-            self.r.a = v = self.r.a >> 1
+            v_old = self.r.a
+            self.r.a = v = v_old >> 1
         else:
-            v = self.mmu.read(a)
-            self.r.setFlag('C', v & 0x01)
-            v = v >> 1
+            v_old = self.mmu.read(a)
+            v = v_old >> 1
             self.mmu.write(a, v)
 
-        self.r.ZN(v)
+        self.r.p = (self.r.p & 0x7c) | (v_old & 0x01) | self.r.NZ[v]
 
     def NOP(self, _):
         pass
@@ -784,27 +1301,25 @@ class CPU:
 
     def ROL(self, a):
         if a == "a":
-            v_old = self.r.a
-            self.r.a = v_new = ((v_old << 1) + self.r.getFlag('C')) & 0xff
+            v = (self.r.a << 1) | (self.r.p & 0x01)
+            self.r.a = v & 0xff
         else:
-            v_old = self.mmu.read(a)
-            v_new = ((v_old << 1) + self.r.getFlag('C')) & 0xff
-            self.mmu.write(a, v_new)
+            v = (self.mmu.read(a) << 1) | (self.r.p & 0x01)
+            self.mmu.write(a, v & 0xff)
 
-        self.r.setFlag('C', v_old & 0x80)
-        self.r.ZN(v_new)
+        # The old bit 7 is now bit 8, the carry.
+        self.r.p = (self.r.p & 0x7c) | self.r.NZC[v]
 
     def ROR(self, a):
         if a == "a":
             v_old = self.r.a
-            self.r.a = v_new = ((v_old >> 1) + self.r.getFlag('C')*0x80) & 0xff
+            self.r.a = v_new = (v_old >> 1) | ((self.r.p & 0x01) << 7)
         else:
             v_old = self.mmu.read(a)
-            v_new = ((v_old >> 1) + self.r.getFlag('C')*0x80) & 0xff
+            v_new = (v_old >> 1) | ((self.r.p & 0x01) << 7)
             self.mmu.write(a, v_new)
 
-        self.r.setFlag('C', v_old & 0x01)
-        self.r.ZN(v_new)
+        self.r.p = (self.r.p & 0x7c) | (v_old & 0x01) | self.r.NZ[v_new]
 
     def RTI(self, _):
         self.r.p = self.stackPop()
@@ -815,18 +1330,21 @@ class CPU:
 
     def SBC(self, v2):
         v1 = self.r.a
-        if self.r.getFlag('D'):
-            d1 = self.fromBCD(v1)
-            d2 = self.fromBCD(v2)
-            r = d1 - d2 - (not self.r.getFlag('C'))
-            self.r.a = self.toBCD(r % 100)
-        else:
-            r = v1 - v2 - (not self.r.getFlag('C'))
-            self.r.a = r & 0xff
-
-        self.r.setFlag('C', r >= 0)
-        self.r.setFlag('V', ((v1 ^ v2) & (v1 ^ r) & 0x80))
-        self.r.ZN(self.r.a)
+        p = self.r.p
+        if p & 0x08:
+            if self.decimal_sbc is None:
+                self._buildDecimalTables()
+            e = self.decimal_sbc[(p & 0x01) << 16 | v1 << 8 | v2]
+            self.r.a = e & 0xff
+            self.r.p = (p & 0x3c) | (e >> 8)
+            return
+
+        r = v1 - v2 - 1 + (p & 0x01)
+        self.r.a = r & 0xff
+
+        # C, Z, N and V.
+        self.r.p = ((p & 0x3c) | (r >= 0) | self.r.NZ[self.r.a]
+                    | (((v1 ^ v2) & (v1 ^ r) & 0x80) >> 1))
 
     def STA(self, a):
         self.mmu.write(a, self.r.a)
@@ -868,7 +1386,7 @@ class CPU:
 
     def AAC(self, v):  # ANC
         self.AND(v)
-        self.r.setFlag('C', self.r.getFlag('N'))
+        self.r.p = (self.r.p & 0xfe) | (self.r.p >> 7)
 
     def AAX(self, a):  # SAX, AXS
         r = self.r.a & self.r.x
@@ -878,8 +1396,9 @@ class CPU:
     def ARR(self, v):
         self.AND(v)
         self.ROR('a')
-        self.r.setFlag('C', self.r.a & 0x40)
-        self.r.setFlag('V', bool(self.r.a & 0x40) ^ bool(self.r.a & 0x20))
+        # C is bit 6 of A and V is bit 6 xor bit 5.
+        a = self.r.a
+        self.r.p = (self.r.p & 0xbe) | ((a >> 6) & 0x01) | ((a ^ (a << 1)) & 0x40)
 
     def ASR(self, v):  # ALR
         self.AND(v)
@@ -914,8 +1433,7 @@ class CPU:
         o = self.r.a & self.r.x
         self.r.x = (o - v) & 0xff
 
-        self.r.setFlag('C', v <= o)
-        self.r.ZN(self.r.x)
+        self.r.p = (self.r.p & 0x7c) | self.r.NZC[o - v + 0x100]
 
     def DCP(self, a):  # DCM
         self.DEC(a)
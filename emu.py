@@ -1,82 +1,75 @@
 import pygame
 import os
-from cpu import CPU
-from mmu import MMU
-from keyboard import Keyboard
-from cassette import Cassette
+import math
+import threading
+from machine import Machine
+from pacer import Pacer
+from tapes import TapeLibrary
+from snapshot import Snapshot, SnapshotError
 import time 
 
 class Emulator:
     """
     
-    Contains 8080 CPU that runs the Sol-20 CONSOL application and uses PyGame to display the 64 x 16 text screen.
+    Wraps the Challenger 1P Machine with a PyGame display of the 32 x 32 (or 64 x 32 for cwmhigh) text screen.
     
     """
-    RAM_ADDRESS = 0x0000
-    BASIC_ADDRESS = 0xA000
-    VIDEO_ADDRESS = 0xD000
-    CHARSET_ADDRESS = 0xD800
-    KEYBOARD_ADDRESS = 0xDF00
-    IO_ADDRESS = 0xE000
-    CASSETTE_ADDRESS = 0xF000
-    MEMORY_BLOCK = 0xF100
-    MONITOR_ADDRESS = 0xF800
+    VIDEO_ADDRESS = Machine.VIDEO_ADDRESS
+    CHARSET_ADDRESS = Machine.CHARSET_ADDRESS
     
     BLACK = 0x000000
     WHITE = 0xFFFFFF
     GREEN = 0x00FF00
     AMBER = 0xFFBF00
     CAPTION_FORMAT = 'Challenger 4P ({})'
+    TURBO_CAPTION_FORMAT = 'Challenger 4P ({}) TURBO'
     
-    VIDEO_MEMORY_SIZE = 1024
-    VIDEO_ROW_SIZE = 32
-    VIDEO_NUM_ROWS = 32
+    # Posted by the CPU thread when it has a new frame to show.
+    FRAME_EVENT = pygame.USEREVENT
+    
+    VIDEO_NUM_ROWS = Machine.VIDEO_NUM_ROWS
+    
+    # The 8 pixels for each byte of the character generator, 1 for the
+    # foreground and 0 for the background.
+    GLYPH_ROWS = [bytes((b >> (7-bit)) & 1 for bit in range(8)) for b in range(256)]
    
     
-    def __init__(self, path=None):
-        # Manage the transformation between actual key presses and what the
-        #  Monitor program is expecting.
-        self.keyboard = Keyboard()
-        
-        # Manage the ACIA cassette deck.
-        self.cassette = Cassette()
+    SNAPSHOT_FILE = "snapshot.c1p"
+    
+    def __init__(self, path=None, snapshot=None):
+        # The display free core of the emulator.
+        self.machine = Machine(path)
+        self.keyboard = self.machine.keyboard
+        self.cassette = self.machine.cassette
+        self.mmu = self.machine.mmu
+        self.cpu = self.machine.cpu
+        
+        # Set the screen width.
+        self.VIDEO_ROW_SIZE = self.machine.VIDEO_ROW_SIZE
+        self.VIDEO_MEMORY_SIZE = self.machine.VIDEO_MEMORY_SIZE
     
         # Remember what is currently showing on the screen.
         self.video_cache = bytearray(self.VIDEO_MEMORY_SIZE)
         
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        basic = open(dir_path+"/ROMs/basic.hex", "r")  # 8K MS Basic.
-        monitor = open(dir_path+"/ROMs/"+path, "r")  # 2K Monitor Program.
-        charset = open(dir_path+"/ROMs/charset.hex", "r")  # 2K character generator.
-        
-        # Set the screen width and keyboard read (inverted or normal).
-        if path == "cwmhigh.hex":
-            self.VIDEO_ROW_SIZE = 64
-            self.VIDEO_MEMORY_SIZE = 2048
-            self.keyboard.INVERT_KEY = True
-            self.CASSETTE_ADDRESS = 0xFC00
-            self.cassette.CONTROL_STATUS = 0xFC00
-            self.cassette.READ_WRITE = 0xFC01
-            self.video_cache = bytearray(self.VIDEO_MEMORY_SIZE)
-        
-        
-        # Define blocks of memory.  Each tuple is
-        # (start_address, length, readOnly=True, value=None, valueOffset=0)
-        self.mmu = MMU([
-                (self.RAM_ADDRESS, 40960), # Create RAM with 40K.
-                (self.BASIC_ADDRESS, 8192, True, basic), # Basic.
-                (self.VIDEO_ADDRESS, self.VIDEO_MEMORY_SIZE), # Video Memory.
-                (self.CHARSET_ADDRESS, 2048, True, charset), # Character Generator.
-                (self.IO_ADDRESS, 6144), # Memory mapped IO
-                (self.MEMORY_BLOCK, 1792), # Memory used by 4P
-                (self.MONITOR_ADDRESS, 2048, True, monitor), # Advanced Monikeyboardtor.
-                (self.KEYBOARD_ADDRESS, 2, False, None, 0, self.keyboard.callback), # Keyboard Control.
-                (self.CASSETTE_ADDRESS, 2, False, None, 0, self.cassette.callback) # Cassette Control.
-                
-        ])
+        # Have the MMU note which bytes of video memory get written so only
+        # those characters are redrawn.
+        self.mmu.track(self.VIDEO_ADDRESS, self.VIDEO_MEMORY_SIZE)
         
-        # Create the CPU with the MMU and the starting program counter address.
-        self.cpu = CPU(self.mmu, 0xFF00)
+        # Run at the speed of a real C1P unless turbo mode is on.
+        self.path = path
+        self.pacer = Pacer(self.machine.CPU_CLOCK, self.machine.FRAME_RATE)
+        
+        # The files the load popup offers.
+        self.tapes = TapeLibrary("TAPEs")
+        
+        # Where F5 saves the machine and F9 restores it from.
+        self.snapshot_file = snapshot if snapshot else self.SNAPSHOT_FILE
+        
+        # The CPU runs on its own thread and holds `lock` while it runs a
+        # frame. Each frame it hands the video memory and the addresses
+        # written over in `frame`, once the main thread has taken the last.
+        self.lock = threading.Lock()
+        self.frame = None
         
         # Determine the monitor screen size.
         pygame.init()
@@ -116,48 +109,9 @@ class Emulator:
         self.invert_screen = False
         self.char_foreground_color = self.WHITE
         self.char_background_color = self.BLACK
-        self.color_depth = 8
         self.is_cursor = False
         self.blinking_cursor = False
         
-        # Character position into the display based on integer position in video memory.
-        self.x_pos = []
-        self.y_pos = []
-        
-        # Create the display characters based on the original C1P ROM.
-        self.characters = []
-        fore = self.char_foreground_color
-        back = self.char_background_color
-        if self.invert_screen == True:
-            fore = self.char_background_color
-            back = self.char_foreground_color
-        for c in range(0,255):
-            image = pygame.Surface((self.character_width, self.character_height), depth=self.color_depth)
-            image.fill(back)
-
-            for row in range(0,8):
-                    byte = self.mmu.memory[self.CHARSET_ADDRESS+c*8+row]
-                    bit = 0x80
-                    for col in range(0,8):
-                        if byte & bit > 0:
-                            image.set_at((col, row), fore)
-                        bit = bit >> 1
-            self.characters.append(image)
-            
-        # Calculate the character positions on the screen based on the integer position into the video memory.
-        x = 0
-        y = 0
-        for i in range(self.VIDEO_MEMORY_SIZE):
-            # Remember the position for this video memory offset.
-            self.x_pos.append(x+self.x_offset)
-            self.y_pos.append(y+self.y_offset)
-            
-            # Get ready for the next character.
-            x += self.character_width;
-            if x == self.character_width*self.VIDEO_ROW_SIZE:
-                x = 0;
-                y += self.character_height
-        
         # Create the screen.
         if self.full_screen:
             self.show_size = (720, 480)
@@ -167,13 +121,69 @@ class Emulator:
             self.screen = pygame.display.set_mode(self.show_size)
             pygame.display.set_caption(self.CAPTION_FORMAT.format(path))
         
-        # Build the screen here.
-        self.setup = pygame.Surface((self.display_width, self.display_height))
+        # In a window the screen is a whole multiple of the display so the
+        # characters are drawn straight onto it. The composite monitor is
+        # stretched to 720 x 480, there the characters are drawn on `setup`
+        # and the changed rows are scaled onto the screen.
+        self.direct = not self.full_screen
+        if self.direct:
+            self.glyph_scale = self.screen_scale
+            self.target = self.screen
+        else:
+            self.glyph_scale = 1
+            self.setup = pygame.Surface((self.display_width, self.display_height))
+            self.target = self.setup
+            
+        # The pixels of `setup` and of the screen line up every `step` pixels
+        # of `setup` and `show` pixels of the screen.
+        self.scale_step = []
+        for size, show in zip((self.display_width, self.display_height), self.show_size):
+            common = math.gcd(size, show)
+            self.scale_step.append((size // common, show // common))
+        
+        # Create the display characters based on the original C1P ROM.
+        self._build_glyphs()
+            
+        # Calculate the character positions on the target surface based on
+        # the integer position into the video memory.
+        self.x_pos = [(self.x_offset + (i % self.VIDEO_ROW_SIZE) * self.character_width) * self.glyph_scale
+                      for i in range(self.VIDEO_MEMORY_SIZE)]
+        self.y_pos = [(self.y_offset + (i // self.VIDEO_ROW_SIZE) * self.character_height) * self.glyph_scale
+                      for i in range(self.VIDEO_MEMORY_SIZE)]
         
         # Clear the screen.
         self.screen.fill(self.BLACK)
         
     
+    def _build_glyphs(self):
+        """
+        Build all 256 characters from the character generator ROM as one
+        coloured image, 8 x 2048 pixels before scaling, with the character
+        for code c at row c*8.
+        """
+        fore = self.char_foreground_color
+        back = self.char_background_color
+        if self.invert_screen == True:
+            fore = self.char_background_color
+            back = self.char_foreground_color
+        
+        # The character generator bytes run down the image one row of pixels
+        # each, so expand every bit to a palette index.
+        charset = self.mmu.memory[self.CHARSET_ADDRESS:self.CHARSET_ADDRESS+256*self.character_height]
+        pixels = b"".join([self.GLYPH_ROWS[b] for b in charset])
+        size = (self.character_width, 256*self.character_height)
+        image = pygame.image.frombuffer(pixels, size, "P")
+        image.set_palette([((c >> 16) & 0xff, (c >> 8) & 0xff, c & 0xff) for c in (back, fore)])
+        
+        if self.glyph_scale != 1:
+            image = pygame.transform.scale(image, (size[0]*self.glyph_scale, size[1]*self.glyph_scale))
+        self.glyphs = image.convert(self.target)
+        
+        # Where each character is in the image.
+        width = self.character_width * self.glyph_scale
+        height = self.character_height * self.glyph_scale
+        self.glyph_areas = [pygame.Rect(0, c*height, width, height) for c in range(256)]
+        
     # Update the screen with the characters from the shared display memory.
     def _refresh(self):
         """
@@ -181,38 +191,100 @@ class Emulator:
 
         """
        
-        # Display the whole screen if any changes have been made.
-        x = 0
-        y = 0
-        changed = False
-        for i in range(self.VIDEO_MEMORY_SIZE):
-            c = self.mmu.memory[self.VIDEO_ADDRESS + i]
+        # Only look at the video memory written since the last refresh.
+        dirty = self.mmu.dirty
+        if not dirty:
+            return
+        self.mmu.dirty = set()
+        self._draw(self.machine.video_bytes(), dirty)
+        
+    # Draw the frame handed over by the CPU thread, if there is one.
+    def _show_frame(self):
+        frame = self.frame
+        if frame is not None:
+            self.frame = None
+            self._draw(*frame)
+        
+    def _draw(self, video, dirty):
+        """
+        Draw the characters at the written addresses from a copy of the
+        video memory.
+        """
+        
+        # The first and last column changed on each row.
+        spans = {}
+        for addr in dirty:
+            i = addr - self.VIDEO_ADDRESS
+            if i < 0 or i >= self.VIDEO_MEMORY_SIZE:
+                continue
+            c = video[i]
             
             if c != self.video_cache[i]:
                 
                 # Only blit the character to the screen if it's different than the current one.
                 if self.hide_control_characters and c < 32:
                     # Blank control characters if switch set.
-                    self.setup.blit(self.characters[32], (self.x_pos[i], self.y_pos[i]))
+                    self.target.blit(self.glyphs, (self.x_pos[i], self.y_pos[i]), self.glyph_areas[32])
                 else:
-                    self.setup.blit(self.characters[c], (self.x_pos[i], self.y_pos[i])) 
+                    self.target.blit(self.glyphs, (self.x_pos[i], self.y_pos[i]), self.glyph_areas[c])
                 
                 # Remember that the screen has been uopdated and what it was changed to.
                 self.video_cache[i] = c
                 
-                # Have to refresh screen
-                changed = True
+                # Remember which part of the row has to be shown.
+                row, col = divmod(i, self.VIDEO_ROW_SIZE)
+                if row in spans:
+                    first, last = spans[row]
+                    spans[row] = (min(first, col), max(last, col))
+                else:
+                    spans[row] = (col, col)
 
-                
-        if changed == True:
-            pygame.transform.scale(self.setup, self.show_size, self.screen)
-            pygame.display.update()
-        
+        # Show just the changed part of each row, scaling it onto the screen
+        # if it wasn't drawn there directly.
+        rects = []
+        width = self.character_width * self.glyph_scale
+        height = self.character_height * self.glyph_scale
+        step_x, show_x = self.scale_step[0]
+        step_y, show_y = self.scale_step[1]
+        for row, (first, last) in spans.items():
+            i = row * self.VIDEO_ROW_SIZE
+            area = pygame.Rect(self.x_pos[i+first], self.y_pos[i], (last-first+1)*width, height)
+            if self.direct:
+                rects.append(area)
+                continue
+            # Widen the area to where the pixels of `setup` and the screen
+            # line up so it scales just like the whole screen would.
+            left = area.left // step_x
+            top = area.top // step_y
+            right = -(-area.right // step_x)
+            bottom = -(-area.bottom // step_y)
+            area = pygame.Rect(left*step_x, top*step_y, (right-left)*step_x, (bottom-top)*step_y)
+            rect = pygame.Rect(left*show_x, top*show_y, (right-left)*show_x, (bottom-top)*show_y)
+            pygame.transform.scale(self.setup.subsurface(area), rect.size, self.screen.subsurface(rect))
+            rects.append(rect)
+        if rects:
+            pygame.display.update(rects)
+        
+    # Have the characters in part of video memory redrawn after changing
+    # the memory directly rather than through the MMU.
+    def _touch(self, offset, length):
+        address = self.VIDEO_ADDRESS + offset
+        self.mmu.dirty.update(range(address, address+length))
     
     def write_text(self, memory, address, x, y, text):
         offset = y * self.VIDEO_ROW_SIZE + x
         for i in range(0, len(text)):
             memory[address+offset+i] = ord(text[i])
+        self._touch(offset, len(text))
+            
+    # Save the BASIC program in memory to the file. If BASIC isn't running
+    # fall back to capturing what is written to the cassette.
+    def save(self, filename):
+        listing = self.machine.basic.list()
+        if listing is None:
+            self.cassette.save(filename)
+        else:
+            self.cassette.write(filename, listing)
             
     def save_popup(self):
         
@@ -227,6 +299,7 @@ class Emulator:
         
         # Clear screen memory.
         memory[address:address+self.VIDEO_MEMORY_SIZE] = bytearray([32]*self.VIDEO_MEMORY_SIZE)
+        self._touch(0, self.VIDEO_MEMORY_SIZE)
         
         # Screen offsets.
         MAX_NAME_SIZE = 20
@@ -274,7 +347,7 @@ class Emulator:
                             self._refresh()
                             over_write = True
                         else:
-                            self.cassette.save(filename_str)
+                            self.save(filename_str)
                             no_key = False
                     elif event.key == pygame.K_BACKSPACE:
                         if name_offset > 0:
@@ -291,7 +364,7 @@ class Emulator:
                         if over_write:
                             # Just looking for a Y. Any other character skips.
                             if key == "Y" or key == "y":
-                                self.cassette.save(filename_str)
+                                self.save(filename_str)
                             no_key = False
                         elif str.isalpha(key) or str.isdigit(key) or key in valid_chars:
                             if name_offset < MAX_NAME_SIZE:
@@ -303,6 +376,7 @@ class Emulator:
                                 self._refresh()
         # Restore the screen.
         memory[address:address+self.VIDEO_MEMORY_SIZE] = save_memory
+        self._touch(0, self.VIDEO_MEMORY_SIZE)
         self._refresh()
         self.keyboard.inPopup = False
         
@@ -314,6 +388,9 @@ class Emulator:
         # Max number of files to show in the list.
         MAX_FILES = 15
         FIRST_FILE_ROW = 5
+        FIND_ROW = 3
+        MAX_FIND = 12
+        TITLE_ROW = 20
                                 
         
         memory = self.mmu.memory
@@ -324,94 +401,201 @@ class Emulator:
         
         # Clear screen memory.
         memory[address:address+self.VIDEO_MEMORY_SIZE] = bytearray([32]*self.VIDEO_MEMORY_SIZE)
+        self._touch(0, self.VIDEO_MEMORY_SIZE)
         
-        # Get a list of the .BAS files in the TAPEs folder.
-        basic_files = []
-        for file in os.listdir("TAPEs"):
-            if file.lower().endswith(".bas") or file.lower().endswith(".mon"):
-                basic_files.append(file)
+        # Bring the index of the TAPEs folder up to date.
+        self.tapes.refresh()
+        tape_files = self.tapes.names
+        last_file = max(len(tape_files)-1, 0)
                 
         # Show the static text.
         self.write_text(memory, address, 4, 1, "SELECT THE FILE TO LOAD")
-        self.write_text(memory, address, 5, 24, ",<       PREVIOUS FILE")
-        self.write_text(memory, address, 5, 25, ".>       NEXT FILE")
-        self.write_text(memory, address, 5, 26, "RETURN   SELECT FILE")
+        self.write_text(memory, address, 4, FIND_ROW, "FIND:")
+        self.write_text(memory, address, 5, 21, ",< .>    PREV/NEXT FILE")
+        self.write_text(memory, address, 5, 22, "PGUP/DN  PREV/NEXT PAGE")
+        self.write_text(memory, address, 5, 23, "A-Z 0-9  FIND FILE")
+        self.write_text(memory, address, 5, 24, "RETURN   SELECT FILE")
+        self.write_text(memory, address, 5, 25, "TAB      FAST LOAD BASIC")
+        self.write_text(memory, address, 5, 26, "INS      TYPE IN FILE")
         self.write_text(memory, address, 5, 27, "ESC      CANCEL")
         
-        # Show the initial list of files on the screen.
-        x = 5
-        y = FIRST_FILE_ROW 
-        for file in basic_files:
-            self.write_text(memory, address, x, y, file)
-            y += 1
-            if y-FIRST_FILE_ROW == MAX_FILES:
-                break
-        
-        # Initialize list controls.
+        # Initialize list controls.  `selected_file` is the index of the
+        # file in the whole list and `files_offset` the first one showing.
+        width = self.VIDEO_ROW_SIZE - 5
         files_offset = 0
+        shown_offset = None
         selected_file = 0
-        last_file = MAX_FILES
-        if last_file > len(basic_files):
-            last_file = len(basic_files)
-            
-        # Show the selected file.
-        self.write_text(memory, address, 4, FIRST_FILE_ROW, ">")
+        marker_row = FIRST_FILE_ROW
+        find = ""
         
-        # Show the screen to the user.
-        self._refresh()
+        # Shown in place of the title until the next key.
+        message = ""
          
         # Wait for a key.
         no_key = True
+        update = True
         while no_key:
+            if update:
+                # Scroll the list so the selected file shows, the names
+                # are only redrawn when the page moves.
+                if selected_file < files_offset:
+                    files_offset = selected_file
+                elif selected_file >= files_offset + MAX_FILES:
+                    files_offset = selected_file - MAX_FILES + 1
+                if files_offset != shown_offset:
+                    for row in range(MAX_FILES):
+                        i = files_offset + row
+                        name = tape_files[i] if i < len(tape_files) else ""
+                        self.write_text(memory, address, 5, FIRST_FILE_ROW+row, name[:width].ljust(width))
+                    shown_offset = files_offset
+                
+                # Show the selected file and its title.
+                self.write_text(memory, address, 4, marker_row, " ")
+                marker_row = FIRST_FILE_ROW + selected_file - files_offset
+                self.write_text(memory, address, 4, marker_row, ">")
+                title = self.tapes.title(tape_files[selected_file]) if tape_files else ""
+                if message:
+                    title = message
+                self.write_text(memory, address, 4, TITLE_ROW, title[:width+1].ljust(width+1))
+                self.write_text(memory, address, 10, FIND_ROW, (find+"_").ljust(MAX_FIND+1))
+                
+                # Show the screen to the user.
+                self._refresh()
+                update = False
+                
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     no_key = False
                 elif event.type == pygame.KEYDOWN:
+                    update = True
+                    message = ""
                     if event.key == pygame.K_ESCAPE:
                         no_key = False
                     elif event.key == pygame.K_RETURN:
-                        self.cassette.load(basic_files[files_offset+selected_file])
-                        no_key = False
+                        if tape_files:
+                            self.cassette.load(tape_files[selected_file])
+                            no_key = False
+                    elif event.key == pygame.K_TAB:
+                        # Put a BASIC program straight into memory.
+                        if tape_files and tape_files[selected_file].lower().endswith(".bas"):
+                            basic = self.machine.basic
+                            if basic.load(self.cassette.read(tape_files[selected_file])) is not None:
+                                no_key = False
+                            elif basic.started():
+                                message = "PROGRAM IS TOO BIG TO LOAD"
+                            else:
+                                message = "BASIC IS NOT RUNNING"
+                    elif event.key == pygame.K_INSERT:
+                        # Type the file in through the keyboard.
+                        if tape_files:
+                            self.keyboard.autoTypeFile(os.path.join("TAPEs", tape_files[selected_file]))
+                            no_key = False
                     elif event.key == pygame.K_PERIOD:
-                        self.write_text(memory, address, 4, FIRST_FILE_ROW+selected_file, " ")
-                        if selected_file < last_file-1:   
-                            selected_file += 1
-                        elif MAX_FILES + files_offset < len(basic_files):
-                            # Adjust the file list.
-                            x = 5
-                            y = FIRST_FILE_ROW
-                            files_offset += 1
-                            for i in range(files_offset,files_offset+MAX_FILES):
-                                memory[address+self.VIDEO_ROW_SIZE*y:address+self.VIDEO_ROW_SIZE*y+self.VIDEO_ROW_SIZE] = bytearray([32]*self.VIDEO_ROW_SIZE)
-                                self.write_text(memory, address, x, y, basic_files[i])
-                                y += 1
-                        self.write_text(memory, address, 4, FIRST_FILE_ROW+selected_file, ">")
-                        self._refresh()
+                        selected_file = min(selected_file+1, last_file)
                     elif event.key == pygame.K_COMMA:
-                        self.write_text(memory, address, 4, FIRST_FILE_ROW+selected_file, " ")
-                        if selected_file > 0:   
-                            selected_file -= 1
-                        elif files_offset > 0:
-                            # Adjust the file list.
-                            x = 5
-                            y = FIRST_FILE_ROW
-                            files_offset -= 1
-                            for i in range(files_offset,files_offset+MAX_FILES):
-                                memory[address+self.VIDEO_ROW_SIZE*y:address+self.VIDEO_ROW_SIZE*y+self.VIDEO_ROW_SIZE] = bytearray([32]*self.VIDEO_ROW_SIZE)
-                                self.write_text(memory, address, x, y, basic_files[i])
-                                y += 1 
-                            
-                        self.write_text(memory, address, 4, FIRST_FILE_ROW+selected_file, ">")
-                        self._refresh()
+                        selected_file = max(selected_file-1, 0)
+                    elif event.key == pygame.K_PAGEDOWN:
+                        selected_file = min(selected_file+MAX_FILES, last_file)
+                    elif event.key == pygame.K_PAGEUP:
+                        selected_file = max(selected_file-MAX_FILES, 0)
+                    elif event.key == pygame.K_BACKSPACE:
+                        find = find[:-1]
+                        if find:
+                            selected_file = self.tapes.find(find)
+                    elif event.unicode.isalnum() and event.unicode.isascii() and len(find) < MAX_FIND:
+                        # Jump to the first file starting with what has
+                        # been typed.
+                        find += event.unicode
+                        selected_file = self.tapes.find(find)
         
         # Restore the screen.
         memory[address:address+self.VIDEO_MEMORY_SIZE] = save_memory
+        self._touch(0, self.VIDEO_MEMORY_SIZE)
         self._refresh()
         self.keyboard.inPopup = False
     
     # Restart the monitor.
     def reset(self):
-        self.cpu.r.pc = 0xff00
+        self.keyboard.cancelType()
+        self.machine.reset()
+        
+    # Type in the text on the clipboard.
+    def paste(self):
+        try:
+            if not pygame.scrap.get_init():
+                pygame.scrap.init()
+            text = pygame.scrap.get(pygame.SCRAP_TEXT)
+        except pygame.error:
+            return
+        if text:
+            self.keyboard.autoType(text.rstrip(b'\0'))
+        
+    # Save the whole machine to the snapshot file.
+    def save_snapshot(self):
+        try:
+            Snapshot.save(self.machine, self.snapshot_file)
+        except OSError as e:
+            print("Can't save snapshot:", e)
+            
+    # Put the machine back the way it was in the snapshot file, returns False
+    # if it couldn't be.
+    def restore_snapshot(self):
+        try:
+            Snapshot.restore(self.machine, self.snapshot_file)
+        except (OSError, SnapshotError) as e:
+            print("Can't restore snapshot:", e)
+            return False
+        self.pacer.sync(self.cpu.cycles)
+        return True
+        
+    # Switch between real C1P speed and running as fast as possible.
+    def toggle_turbo(self):
+        self.pacer.toggleTurbo(self.cpu.cycles)
+        if not self.full_screen:
+            caption = self.TURBO_CAPTION_FORMAT if self.pacer.turbo else self.CAPTION_FORMAT
+            pygame.display.set_caption(caption.format(self.path))
+            
+    # Hold the CPU thread at the end of its frame so the main thread can use
+    # the machine, and let it go again.
+    def _stop_cpu(self):
+        self.lock.acquire()
+        self._show_frame()
+        
+    def _start_cpu(self):
+        self.lock.release()
+        self.keyboard.wakeup.set()
+        
+    def _run_cpu(self):
+        """
+        The CPU thread. Runs the machine a frame at a time at the pace of a
+        real C1P and hands the frames over to be drawn.
+        """
+        machine = self.machine
+        keyboard = self.keyboard
+        while True:
+            with self.lock:
+                keyboard.wakeup.clear()
+                keyboard.applyKeys()
+                machine.run(machine.CYCLES_PER_FRAME)
+                idle = machine.idle()
+            
+                # Hand over the frame unless the last one hasn't been drawn
+                # yet, then the writes are kept for the next one.
+                if self.frame is None and self.mmu.dirty and self.pacer.frameDue():
+                    dirty = self.mmu.dirty
+                    self.mmu.dirty = set()
+                    self.frame = (machine.video_bytes(), dirty)
+                    pygame.event.post(pygame.event.Event(self.FRAME_EVENT))
+                
+            if idle:
+                # The ROM is only polling the keyboard, so sleep until a key
+                # changes or the main thread has used the machine.
+                keyboard.wakeup.wait()
+                self.pacer.sync(self.cpu.cycles)
+            else:
+                # Wait for real time to catch up, a key change gets the next
+                # frame going straight away.
+                self.pacer.pace(self.cpu.cycles, keyboard.wakeup)
                 
     def run(self):
         """
@@ -424,25 +608,53 @@ class Emulator:
         self.screen.fill(self.BLACK)
         pygame.display.update()
         
+        # The CPU runs on its own thread, this one handles the display and
+        # the keyboard.
+        threading.Thread(target=self._run_cpu, daemon=True).start()
+        
         # Main loop.
         while True:
-            for event in pygame.event.get():
+            for event in [pygame.event.wait()] + pygame.event.get():
                 if event.type == pygame.QUIT:
+                    self._stop_cpu()
+                    self.cassette.close()
                     exit()
                 elif event.type == pygame.VIDEOEXPOSE:
                     pygame.display.update()
                 elif event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_CAPSLOCK:
                         if pygame.key.get_mods() & pygame.KMOD_CAPS > 0:
-                            self.keyboard.pressKey(event.key)
+                            self.keyboard.queuePress(event.key)
                     elif event.unicode == '\x12': # CTRL-R
+                        self._stop_cpu()
                         self.reset()
+                        self._start_cpu()
+                    elif event.unicode == '\x14': # CTRL-T
+                        self._stop_cpu()
+                        self.toggle_turbo()
+                        self._start_cpu()
                     elif event.unicode == '\x18': # CTRL-X
+                        self._stop_cpu()
+                        self.cassette.close()
                         exit()
                     elif event.unicode == '\x0c': # CTRL-L
+                        self._stop_cpu()
                         self.load_popup()
+                        self._start_cpu()
+                    elif event.unicode == '\x16': # CTRL-V
+                        self.paste()
+                    elif event.key == pygame.K_F5:
+                        self._stop_cpu()
+                        self.save_snapshot()
+                        self._start_cpu()
+                    elif event.key == pygame.K_F9:
+                        self._stop_cpu()
+                        self.restore_snapshot()
+                        self._start_cpu()
                     elif event.unicode == '\x13': # CTRL-S
+                        self._stop_cpu()
                         self.save_popup()
+                        self._start_cpu()
                     else:
                         if event.mod & (self.keyboard.KEY_LCTRL | self.keyboard.KEY_RCTRL) > 0:
                             key = event.key
@@ -451,11 +663,11 @@ class Emulator:
                                 key = ord(event.unicode)
                             except:
                                 key = event.key
-                        self.keyboard.pressKey(key)
+                        self.keyboard.queuePress(key)
                 elif event.type == pygame.KEYUP:
                     if event.key == pygame.K_CAPSLOCK:
                         if not pygame.key.get_mods() & pygame.KMOD_CAPS > 0:
-                            self.keyboard.releaseKey(event.key) 
+                            self.keyboard.queueRelease(event.key) 
                     else:
                         if event.mod & (self.keyboard.KEY_LCTRL | self.keyboard.KEY_RCTRL) > 0:
                             key = event.key
@@ -464,10 +676,7 @@ class Emulator:
                                 key = ord(event.unicode)
                             except:
                                 key = event.key
-                        self.keyboard.releaseKey(key)
+                        self.keyboard.queueRelease(key)
                         
-            # This will run the CPU for about 5K cycles.
-            for _ in range(5000):
-                self.cpu.step()
-            self._refresh()
-            
+            # Draw the latest frame from the CPU thread.
+            self._show_frame()
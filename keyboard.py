@@ -1,6 +1,6 @@
 import pygame
 import threading
-import sched, time
+from collections import deque
 
 HAS_KEYBOARD = False
 try:
@@ -91,17 +91,49 @@ class Keyboard:
     # Keys mapped to rows and columns.
     keys = []
     
-    # Create an instance of the scheduler
-    scheduler = sched.scheduler()
+    # Keys from the hardware keyboard are typed in the same way as auto
+    # typed text, and dropped if there are already this many waiting.
+    KEY_BACKLOG = 16
+    
+    # Auto typing holds each key down until the ROM has read its row this
+    # many times, then leaves it up for this many reads of the keyboard
+    # before the next key.  Four and four are the least all the monitors
+    # take reliably.  A program that doesn't scan the key's row gets it let
+    # go after TYPE_HOLD_MAX_READS reads of any row.
+    TYPE_HOLD_READS = 6
+    TYPE_HOLD_MAX_READS = 256
+    TYPE_GAP_READS = 16
     
     # Depending on the model of Challenger the keyboard pins may have to be inverted when read and written.
     INVERT_KEY = False
     
     # Have to feed hardware keys back to the enulator if we are in a popup.
     inPopup = False
+    
+    # The row select masks that include each row, see `updateRow`.
+    ROW_MASKS = [[m for m in range(256) if m & (1 << row)] for row in range(8)]
 
     def __init__(self):
         self.kbport = 0xff   # Default is to return nothing.
+        
+        # Count the reads so the emulator can tell when the ROM is just
+        # waiting for a key.
+        self.reads = 0
+        
+        # Key presses and releases from the other threads wait here until
+        # the CPU thread applies them to the matrix between frames.  Set
+        # `wakeup` when there is a change so a parked CPU thread gets going.
+        self.changes = deque()
+        self.wakeup = threading.Event()
+        
+        # Keys waiting to be auto typed, each a tuple of the keys to hold
+        # down together, the ones held down and how many more keyboard reads
+        # until the next step, see `autoType`.
+        self.typing = deque()
+        self.type_key = None
+        self.type_row = 0
+        self.type_count = 0
+        self.type_reads = 0
 
         # Build the key matrix.  One byte per row, one bit per column.
         # Keys set bits to 0 when pressed, so we start out with all bits
@@ -110,6 +142,13 @@ class Keyboard:
         for i in range (len(self.matrix)):
             self.matrix[i] = 0xff
             
+        # What a read returns for each byte written to the kbport, kept up
+        # to date as keys go up and down.  `columns` is the same for each
+        # mask of selected rows, before any inversion.
+        self.columns = bytearray(256)
+        self.scan = bytearray(256)
+        self.buildScan()
+            
         # Define keys that need to have shift applied.
         self.shift_keys = {ord("="), ord("\'"), ord("\""), ord("!"), ord("#"), ord("$"), ord("%"), ord("&"), ord("("), ord(")"), ord("*"), ord("+"), ord("<"), ord(">"), ord("?")}
         
@@ -196,6 +235,36 @@ class Keyboard:
     def clearMatrix(self):
         for i in range (len(self.matrix)):
             self.matrix[i] = 0xff
+        self.buildScan()
+        
+    # Read the kbport inverted, as the cwmhigh monitor expects.
+    def setInvert(self, invert):
+        self.INVERT_KEY = invert
+        self.kbport = 0x00 if invert else 0xff
+        self.buildScan()
+        
+    # Work out the whole scan table from the matrix.
+    def buildScan(self):
+        self.columns[0] = 0xff
+        self.scan[0x00 if self.INVERT_KEY else 0xff] = 0x00 if self.INVERT_KEY else 0xff
+        for row in range(len(self.matrix)):
+            self.updateRow(row)
+            
+    def updateRow(self, row):
+        # After a change to a row of the matrix work out again the scan
+        # results for each selection of rows that includes it.  The columns
+        # for the selection without the row don't depend on it.
+        bit = 1 << row
+        value = self.matrix[row]
+        columns = self.columns
+        scan = self.scan
+        if self.INVERT_KEY:
+            select, result = 0x00, 0xff
+        else:
+            select, result = 0xff, 0x00
+        for m in self.ROW_MASKS[row]:
+            columns[m] = columns[m ^ bit] & value
+            scan[m ^ select] = columns[m] ^ result
         
     # Dump the matrix.
     def dumpMatrix(self, label, key):
@@ -225,28 +294,20 @@ class Keyboard:
     def readByte(self):
         # Returns the column values for any row that has been set to a 0
         #  in a value previously written to the kbport address.
-        b = 0xff
-        k = self.kbport
-        for i in range(len(self.matrix)):
-            if k & 1 == 0:
-                b &= self.matrix[i]
-            k >>= 1
-        return b
+        return self.scan[self.kbport]
 
     def writeByte(self, b):
         self.kbport = b
         
     def callback(self, addr, value):
+        # The scan table already allows for INVERT_KEY.
         if value != None:
-            if self.INVERT_KEY == True:
-                self.writeByte(value^0xFF)
-            else:
-                self.writeByte(value)
+            self.kbport = value
         else:
-            if self.INVERT_KEY == True:
-                return self.readByte()^0xFF
-            else:
-                return self.readByte()
+            self.reads += 1
+            if self.typing:
+                self.typeStep()
+            return self.scan[self.kbport]
             
     def hw_getKey(self):
         key = 0
@@ -268,13 +329,7 @@ class Keyboard:
         # Handle CTRL-C. Have to ensure that ctrl gets registered.
         if key == 3:
             # Send the CTRL signal and a C.
-            self.pressKey(self.KEY_LCTRL)
-            self.pressKey(99)
-            
-            # Schedule a key release for both the CTRL signal and C.
-            self.scheduler.enter(.1, 1, self.releaseKey, argument=(self.KEY_LCTRL,))
-            self.scheduler.enter(.1, 1, self.releaseKey, argument=(99,))
-            self.scheduler.run()
+            self.queueTyped(self.KEY_LCTRL, 99)
             return
             
         # If this is one of the special CTRL keys kick them back to the emulator via the event queue.
@@ -288,6 +343,8 @@ class Keyboard:
                 unicode = '\x0c' # CTRL-L
             elif key == 19:
                 unicode = '\x13' # CTRL-S
+            elif key == 20:
+                unicode = '\x14' # CTRL-T
             if unicode != None:
                 # Let the emulator handle these keys.
                 down_event = pygame.event.Event(pygame.KEYDOWN, unicode=unicode, key=key, mod=0)
@@ -305,10 +362,90 @@ class Keyboard:
             pygame.event.post(down_event)
             return
         
-        # Press the key and schedule a release for that key.
-        self.pressKey(key)
-        self.scheduler.enter(.1, 1, self.releaseKey, argument=(key,))
-        self.scheduler.run()
+        # Have the key typed in, without holding up the GPIO callback thread.
+        self.queueTyped(key)
+        
+    # Queue key presses and releases for the CPU thread.
+    def queuePress(self, key):
+        self.changes.append((True, key))
+        self.wakeup.set()
+        
+    def queueRelease(self, key):
+        self.changes.append((False, key))
+        self.wakeup.set()
+        
+    # Type in the text, a string or bytes, as if at the keyboard.  Line ends
+    # become RETURN and characters with no key are skipped.  The keys go in
+    # as fast as the ROM reads the keyboard, whatever the speed of the CPU.
+    def autoType(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('ascii', 'replace')
+        text = text.replace('\r\n', '\r').replace('\n', '\r')
+        for c in text:
+            key = self.KEY_RETURN if c == '\r' else ord(c)
+            if key in self.keys:
+                self.typing.append((key,))
+        self.wakeup.set()
+        
+    # Type in the contents of a file.
+    def autoTypeFile(self, filename):
+        with open(filename, 'rb') as f:
+            self.autoType(f.read())
+            
+    # Stop auto typing, letting go of any key held down.
+    def cancelType(self):
+        self.typing.clear()
+        if self.type_key != None:
+            for key in self.type_key:
+                self.releaseKey(key)
+        self.type_key = None
+        self.type_count = 0
+            
+    # Called for each read of the keyboard while there is text to type.
+    def typeStep(self):
+        if self.type_key != None:
+            # Only count the reads of the row the key is on.
+            self.type_reads -= 1
+            m = self.kbport if self.INVERT_KEY else self.kbport ^ 0xff
+            if not m & self.type_row and self.type_reads > 0:
+                return
+        self.type_count -= 1
+        if self.type_count > 0:
+            return
+        if self.type_key == None:
+            # The last key is the one that is waited on, the others are
+            # held down with it.
+            self.type_key = self.typing[0]
+            self.type_row = 1 << self.keys[self.type_key[-1]][0]
+            for key in self.type_key:
+                self.pressKey(key)
+            self.type_count = self.TYPE_HOLD_READS
+            self.type_reads = self.TYPE_HOLD_MAX_READS
+        else:
+            for key in reversed(self.type_key):
+                self.releaseKey(key)
+            self.typing.popleft()
+            self.type_key = None
+            self.type_count = self.TYPE_GAP_READS
+        
+    # Type the keys in together, as fast as the ROM reads them like auto
+    # typed text.  Keys that come faster than that are dropped once
+    # KEY_BACKLOG are waiting rather than falling further and further
+    # behind, as are keys that aren't on the C1P keyboard.
+    def queueTyped(self, *keys):
+        if all(key in self.keys for key in keys) and len(self.typing) < self.KEY_BACKLOG:
+            self.typing.append(keys)
+            self.wakeup.set()
+        
+    # Called on the CPU thread to apply the queued changes to the matrix.
+    def applyKeys(self):
+        changes = self.changes
+        while changes:
+            pressed, key = changes.popleft()
+            if pressed:
+                self.pressKey(key)
+            else:
+                self.releaseKey(key)
 
     # Handle key presses and releases.
     def pressKey(self, key):
@@ -316,13 +453,17 @@ class Keyboard:
             k = self.keys[key]
             if k != None:
                 self.matrix[k[0]] &= ~(1 << k[1])
+                self.updateRow(k[0])
                 if key in self.shift_keys:
                     self.matrix[0] &= 0b11111101
+                    self.updateRow(0)
 
     def releaseKey(self, key):
         if key in self.keys:
             k = self.keys[key]
             if k != None:
                 self.matrix[k[0]] |= 1 << k[1]
+                self.updateRow(k[0])
                 if key in self.shift_keys:
                     self.matrix[0] |= 0b00000010
+                    self.updateRow(0)
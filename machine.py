@@ -0,0 +1,259 @@
+import os
+import io
+import re
+import hashlib
+from cpu import CPU
+from mmu import MMU
+from keyboard import Keyboard
+from cassette import Cassette
+from basic import Basic
+from snapshot import Snapshot, SnapshotError
+
+class Machine:
+    """
+
+    The Challenger 1P without a display: the 6502 CPU, the memory map, the
+    keyboard matrix and the cassette.  The Emulator wraps it with a PyGame
+    screen, on its own it runs headless as fast as the CPU allows.
+
+    """
+    RAM_ADDRESS = 0x0000
+    BASIC_ADDRESS = 0xA000
+    VIDEO_ADDRESS = 0xD000
+    CHARSET_ADDRESS = 0xD800
+    KEYBOARD_ADDRESS = 0xDF00
+    IO_ADDRESS = 0xE000
+    CASSETTE_ADDRESS = 0xF000
+    MEMORY_BLOCK = 0xF100
+    MONITOR_ADDRESS = 0xF800
+
+    VIDEO_MEMORY_SIZE = 1024
+    VIDEO_ROW_SIZE = 32
+    VIDEO_NUM_ROWS = 32
+
+    # The 6502 is clocked at 3.93216 MHz / 4, just under 1 MHz, and the
+    # display is refreshed 60 times a second.
+    CPU_CLOCK = 983040
+    FRAME_RATE = 60
+    CYCLES_PER_FRAME = CPU_CLOCK // FRAME_RATE
+
+    # A frame counts as idle when the ROM reads the keyboard at least this
+    # many times in it, and the emulator parks after this many idle frames in
+    # a row.
+    IDLE_KEYBOARD_READS = 16
+    IDLE_FRAMES = 2
+
+    # Give up waiting for the monitor's prompt at power on after this many
+    # frames.
+    BOOT_FRAMES = 10 * FRAME_RATE
+
+    # Part of the boot checkpoint's name, changed when what it should hold
+    # changes so the old ones are made again.
+    CHECKPOINT_VERSION = 2
+
+    # Map the character codes to printable ASCII for `video_text`.
+    TEXT_CHARACTERS = bytes(c if 32 <= c < 127 else 32 for c in range(256))
+
+    # All the monitors end their power on prompt with this.
+    PROMPT = re.compile(r"W/M ?\?")
+
+    def __init__(self, path='cegmon.hex', compiled=True, translate=True):
+        self.path = path
+
+        # Manage the transformation between actual key presses and what the
+        #  Monitor program is expecting.
+        self.keyboard = Keyboard()
+
+        # Manage the ACIA cassette deck.
+        self.cassette = Cassette()
+
+        # Set the screen width and keyboard read (inverted or normal).
+        if os.path.splitext(path)[0] == "cwmhigh":
+            self.VIDEO_ROW_SIZE = 64
+            self.VIDEO_MEMORY_SIZE = 2048
+            self.keyboard.setInvert(True)
+            self.CASSETTE_ADDRESS = 0xFC00
+            self.cassette.CONTROL_STATUS = 0xFC00
+            self.cassette.READ_WRITE = 0xFC01
+
+        with self.open_rom("basic.hex") as basic, \
+             self.open_rom(path) as monitor, \
+             self.open_rom("charset.hex") as charset:
+
+            # Define blocks of memory.  Each tuple is
+            # (start_address, length, readOnly=True, value=None, valueOffset=0)
+            self.mmu = MMU([
+                    (self.RAM_ADDRESS, 40960), # Create RAM with 40K.
+                    (self.BASIC_ADDRESS, 8192, True, basic), # Basic.
+                    (self.VIDEO_ADDRESS, self.VIDEO_MEMORY_SIZE), # Video Memory.
+                    (self.CHARSET_ADDRESS, 2048, True, charset), # Character Generator.
+                    (self.IO_ADDRESS, 6144), # Memory mapped IO
+                    (self.MEMORY_BLOCK, 1792), # Memory used by 4P
+                    (self.MONITOR_ADDRESS, 2048, True, monitor), # Advanced Monitor.
+                    (self.KEYBOARD_ADDRESS, 2, False, None, 0, self.keyboard.callback), # Keyboard Control.
+                    (self.CASSETTE_ADDRESS, 2, False, None, 0, self.cassette.callback) # Cassette Control.
+            ])
+
+        # Tokenize BASIC programs straight into memory.
+        self.basic = Basic(self.mmu)
+
+        # Create the CPU with the MMU and the starting program counter address.
+        self.cpu = CPU(self.mmu, 0xFF00, compiled=compiled, translate=translate)
+
+        # What the last frame looked like, for `idle`.
+        self.idle_pc = 0
+        self.idle_memory = None
+        self.idle_frames = 0
+
+    def open_rom(self, name):
+        """
+        Return a binary file holding the ROM image in the ROMs folder. A .bin
+        file is the image itself.  A .hex file is converted once and the
+        image kept in ROMs/cache under the hash of the hex file, so later
+        starts skip parsing it.  The cached image ends with its own SHA-1 and
+        one that doesn't match, cut short by an interrupted run say, is made
+        again from the hex file.
+        """
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + "/ROMs/"
+        if name.lower().endswith(".bin"):
+            return open(dir_path+name, "rb")
+
+        with open(dir_path+name, "rb") as f:
+            source = f.read()
+        cache = "%scache/%s.%s.bin" % (dir_path, name, hashlib.sha1(source).hexdigest())
+        try:
+            with open(cache, "rb") as f:
+                data = f.read()
+            image, digest = data[:-20], data[-20:]
+            if len(data) > 20 and hashlib.sha1(image).digest() == digest:
+                return io.BytesIO(image)
+        except OSError:
+            pass
+
+        image = bytes(int(x, 16) for x in source.split())
+        try:
+            # Write a temporary file and move it into place so a run that
+            # stops part way never leaves a broken image behind.
+            os.makedirs(dir_path+"cache", exist_ok=True)
+            temp = "%s.%d.tmp" % (cache, os.getpid())
+            with open(temp, "wb") as f:
+                f.write(image + hashlib.sha1(image).digest())
+            os.replace(temp, cache)
+        except OSError:
+            # Without a cache the hex file is just parsed every time.
+            pass
+        return io.BytesIO(image)
+
+    def cold_start(self):
+        """
+        Bring the machine up to the monitor's prompt.  The first time for
+        each set of ROMs the reset code is run until the machine goes idle
+        with the prompt on the screen and a checkpoint is saved in ROMs/cache
+        under the hash of the ROM bytes in memory, after that the checkpoint
+        is restored instead.  A checkpoint that can't be restored or doesn't
+        show the prompt is thrown away and the machine booted for real.
+        Returns True if the checkpoint was used.
+        """
+        cache = os.path.dirname(os.path.realpath(__file__)) + "/ROMs/cache/"
+        checkpoint = "%sboot%d.%s.c1p" % (cache, self.CHECKPOINT_VERSION, self.rom_hash().hex())
+        try:
+            Snapshot.restore(self, checkpoint)
+            if self.at_prompt():
+                return True
+            os.remove(checkpoint)
+        except (OSError, SnapshotError):
+            pass
+
+        # Start again from power on in case the restore got part way.
+        self.cpu.reset()
+        self.cpu.r.pc = 0xff00
+        self.keyboard.cancelType()
+        self.keyboard.clearMatrix()
+        self.keyboard.pressKey(self.keyboard.KEY_SHIFTLOCK)
+        self.cassette.close()
+        self.cassette.eject()
+        self.idle_frames = 0
+        self.idle_memory = None
+
+        for frame in range(self.BOOT_FRAMES):
+            self.run(self.CYCLES_PER_FRAME)
+            if self.idle() and self.at_prompt():
+                break
+        else:
+            # Never got to a prompt, don't keep the state.
+            return False
+        try:
+            os.makedirs(cache, exist_ok=True)
+            Snapshot.save(self, checkpoint)
+        except OSError:
+            pass
+        return False
+
+    def at_prompt(self):
+        """
+        Return True if the monitor's "C/W/M ?" prompt is on the screen.
+        """
+        return self.PROMPT.search(self.video_text()) is not None
+
+    def rom_hash(self):
+        """
+        Return the SHA-1 digest of all the read only memory: BASIC, the
+        monitor and the character generator.
+        """
+        digest = hashlib.sha1()
+        for start, end in self.mmu.readonlyRanges():
+            digest.update(self.mmu.memory[start:end])
+        return digest.digest()
+
+    # Restart the monitor.
+    def reset(self):
+        self.cpu.r.pc = 0xff00
+
+    def run(self, cycles):
+        """
+        Run the CPU for the given number of cycles. Returns the number of
+        cycles actually used.
+        """
+        return self.cpu.run(cycles)
+
+    def idle(self):
+        """
+        Call once per frame. Returns True when the CPU has spent the last few
+        frames in a tight loop polling the keyboard: lots of keyboard reads,
+        the program counter in the same bit of ROM and nothing in RAM or video
+        memory changed.  Nothing will happen until a key is pressed.  Never
+        idle while there is text being auto typed.
+        """
+        reads = self.keyboard.reads
+        self.keyboard.reads = 0
+        pc = self.cpu.r.pc
+
+        # The stack page is left out, the polling loop's subroutine calls
+        # push different return addresses and registers on each pass.
+        memory = self.mmu.memory
+        snapshot = memory[:0x100] + memory[0x200:self.BASIC_ADDRESS] + \
+            memory[self.VIDEO_ADDRESS:self.VIDEO_ADDRESS+self.VIDEO_MEMORY_SIZE]
+
+        if not self.keyboard.typing and \
+           reads >= self.IDLE_KEYBOARD_READS and pc >= self.BASIC_ADDRESS and \
+           abs(pc - self.idle_pc) < 0x100 and snapshot == self.idle_memory:
+            self.idle_frames += 1
+        else:
+            self.idle_frames = 0
+        self.idle_pc = pc
+        self.idle_memory = snapshot
+        return self.idle_frames >= self.IDLE_FRAMES
+
+    def video_bytes(self):
+        """
+        Return a copy of the video memory.
+        """
+        return bytes(self.mmu.memory[self.VIDEO_ADDRESS:self.VIDEO_ADDRESS+self.VIDEO_MEMORY_SIZE])
+
+    def video_text(self):
+        """
+        Return the video memory as lines of text. Characters without an ASCII
+        equivalent are shown as spaces.
+        """
+        text = self.video_bytes().translate(self.TEXT_CHARACTERS).decode('ascii')
+        return "\n".join(text[i:i+self.VIDEO_ROW_SIZE] for i in range(0, len(text), self.VIDEO_ROW_SIZE))
@@ -1,14 +1,60 @@
 from argparse import ArgumentParser
-from emu import Emulator
+import os
+from snapshot import Snapshot, SnapshotError
 
 
 def main():
     arg_parser = ArgumentParser()
     arg_parser.add_argument('--filename', help='ROM file')
+    arg_parser.add_argument('--headless', action='store_true', help='run without a display')
+    arg_parser.add_argument('--cycles', type=int, help='with --headless, CPU cycles to run before printing the screen')
+    arg_parser.add_argument('--snapshot', help='snapshot file to start from, F5 saves to it and F9 restores it')
+    arg_parser.add_argument('--cold', action='store_true', help='run the monitor reset code rather than start from the boot checkpoint')
     args = arg_parser.parse_args()
 
-    filename = args.filename if args.filename else 'cegmon.hex'
-    emu = Emulator(path=filename)
+    # Start with the monitor the snapshot was taken with.  A snapshot that
+    # can't be read is reported and the machine started afresh instead.
+    resume = args.snapshot and os.path.exists(args.snapshot)
+    filename = args.filename
+    if resume and not filename:
+        try:
+            filename = Snapshot.monitor(args.snapshot)
+        except (OSError, SnapshotError) as e:
+            print("Can't restore snapshot:", e)
+            resume = False
+    if not filename:
+        filename = 'cegmon.hex'
+    
+    if args.headless:
+        # Only the machine core is needed, keep PyGame quiet.
+        os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+        from machine import Machine
+        machine = Machine(path=filename)
+        if resume:
+            try:
+                Snapshot.restore(machine, args.snapshot)
+            except (OSError, SnapshotError) as e:
+                print("Can't restore snapshot:", e)
+                resume = False
+        if not resume and not args.cold:
+            machine.cold_start()
+        try:
+            if args.cycles:
+                machine.run(args.cycles)
+            else:
+                while True:
+                    machine.run(machine.CPU_CLOCK)
+        except KeyboardInterrupt:
+            pass
+        print(machine.video_text())
+        return
+    
+    from emu import Emulator
+    emu = Emulator(path=filename, snapshot=args.snapshot)
+    if resume:
+        resume = emu.restore_snapshot()
+    if not resume and not args.cold:
+        emu.machine.cold_start()
     
     emu.run()
 
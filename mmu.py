@@ -7,6 +7,15 @@ class ReadOnlyError(TypeError):
 
 
 class MMU:
+
+    # Translation tables for `memmap` bytes: plain or watched RAM to 1 and
+    # anything else to 0, read only to 1 and anything else to 0, plain RAM
+    # to watched and watched RAM to plain.
+    WRITABLE = bytes(1 if kind in (0, 2) else 0 for kind in range(256))
+    READONLY = bytes(1 if kind == 1 else 0 for kind in range(256))
+    WATCH = bytes(2 if kind == 0 else kind for kind in range(256))
+    UNWATCH = bytes(0 if kind == 2 else kind for kind in range(256))
+
     def __init__(self, blocks):
         
         # Memory allocated to the 6502.
@@ -18,9 +27,29 @@ class MMU:
         # memory access must pass through.
         self.memmap = bytearray(65536)
         
+        # The (start, end) ranges of writable memory for `reset`, worked out
+        # again when a block is added.
+        self.writable = None
+        
         # Keep track of any callback methods.
         self.callbacks = {}
         self.callbacks[1] = self.readonly
+        self.callbacks[2] = self.watched
+        
+        # Called with the address before a watched byte of RAM is written.
+        self.watcher = None
+        
+        # Pages whose writes are recorded in `dirty`, see `track`.
+        self.tracked = bytearray(256)
+        self.dirty = set()
+        
+        # Page table with a read and a write handler for each 256 byte page.
+        # Plain RAM and ROM pages go straight to the memory, only pages
+        # holding a callback take the slow path through `memmap`.
+        self.readers = [None]*256
+        self.writers = [None]*256
+        for page in range(256):
+            self.updatePage(page)
         
         """
         Initialize the MMU with the blocks specified in blocks.  blocks
@@ -39,19 +68,121 @@ class MMU:
         """
         In all writeable memory reset the values to zero.
         """
-        for i in range(len(self.memory)):
-            if self.memmap[i] == 0:
-                self.memory[i] = 0
+        for start, end in self.writableRanges():
+            self.memory[start:end] = bytes(end-start)
+        self.touchTracked()
+
+    def ranges(self, table):
+        """
+        Return the (start, end) ranges of memory whose memmap entries
+        `table` translates to 1.
+        """
+        ranges = []
+        mask = self.memmap.translate(table)
+        end = 0
+        while True:
+            start = mask.find(1, end)
+            if start < 0:
+                break
+            end = mask.find(0, start)
+            if end < 0:
+                end = len(mask)
+            ranges.append((start, end))
+        return ranges
+
+    def writableRanges(self):
+        if self.writable is None:
+            self.writable = self.ranges(self.WRITABLE)
+        return self.writable
+
+    def readonlyRanges(self):
+        return self.ranges(self.READONLY)
+
+    def touchTracked(self):
+        """
+        Record every address in the tracked pages in `dirty`, after memory
+        has been changed behind the page table's back.
+        """
+        for page in range(256):
+            if self.tracked[page]:
+                self.dirty.update(range(page*256, page*256+256))
     
     # if a memory address is marked read only call this method to access 
     # the memory.      
     def readonly(self, addr, value=None):
+        if value == None:
+            # Trying to read. Just go ahead. Writes are dropped.
+            return self.memory[addr]        
+
+    def dropWrite(self, addr, value):
+        pass
+
+    def updatePage(self, page):
+        """
+        Choose the read and write handlers for a page from its memmap entries.
+        """
+        kinds = set(self.memmap[page*256:page*256+256])
+        
+        # Read only and watched bytes read like plain RAM.
+        if kinds <= {0, 1, 2}:
+            self.readers[page] = self.memory.__getitem__
+        else:
+            self.readers[page] = self.slowRead
+        
+        if kinds == {0}:
+            if self.tracked[page]:
+                self.writers[page] = self.trackedWrite
+            else:
+                self.writers[page] = self.memory.__setitem__
+        elif kinds == {1}:
+            self.writers[page] = self.dropWrite
+        else:
+            self.writers[page] = self.slowWrite
+
+    def trackedWrite(self, addr, value):
+        self.memory[addr] = value
+        self.dirty.add(addr)
+
+    def updatePages(self, start, length):
+        for page in range(start >> 8, ((start+length-1) >> 8) + 1):
+            self.updatePage(page)
+
+    # if a RAM address is being watched call this method to access the
+    # memory.
+    def watched(self, addr, value=None):
         if value != None:
-            # Trying to write. Just post a message.
-            print("Trying to write to a read only address:", hex(addr), hex(value))
+            # Let the watcher know before the byte changes.
+            if self.watcher != None:
+                self.watcher(addr)
+            self.memory[addr] = value
         else:
-            # Trying to read. Just go ahead.
-            return self.memory[addr]        
+            return self.memory[addr]
+
+    def watch(self, start, length):
+        """
+        Have writes to the plain RAM in the range pass through `watched` so
+        that `watcher` is told about them. Used by the CPU to notice when
+        code it has translated is overwritten.
+        """
+        self.memmap[start:start+length] = self.memmap[start:start+length].translate(self.WATCH)
+        self.updatePages(start, length)
+
+    def unwatch(self, start, length):
+        """
+        Return watched RAM in the range to plain RAM.
+        """
+        self.memmap[start:start+length] = self.memmap[start:start+length].translate(self.UNWATCH)
+        self.updatePages(start, length)
+
+    def track(self, start, length):
+        """
+        Record the address of every write to the pages covering the range in
+        the `dirty` set. Used by the display to redraw only the characters
+        that the CPU has written to video memory.
+        """
+        for page in range(start >> 8, ((start+length-1) >> 8) + 1):
+            self.tracked[page] = 1
+        self.updatePages(start, length)
 
     def addBlock(self, start, length, readonly=False, value=None, valueOffset=0, callback=None):
         """
@@ -70,7 +201,8 @@ class MMU:
             Whether the block should be read only (such as ROM) (default False)
         value : file pointer, binary or lint of unsigned integers
             The intial value for the block of memory. Used for loading program
-            data. (Default None)
+            data. A file opened in binary mode is read straight into memory,
+            one opened in text mode holds hex byte values. (Default None)
         valueOffset : integer
             Used when copying the above `value` into the block to offset the
             location it is copied into. For example, to copy byte 0 in `value`
@@ -82,8 +214,7 @@ class MMU:
 
         # See if the block of memory is read only.
         if readonly:
-            for i in range(length):
-                self.memmap[start+i] = 1
+            self.memmap[start:start+length] = bytes([1])*length
                 
         if callback != None:
             # See if the callback has already been defined.
@@ -98,35 +229,49 @@ class MMU:
                 self.callbacks[key] = callback
             
             # Mark the range of memory with the call back key.
-            for i in range(length):
-                self.memmap[start+i] = key
+            self.memmap[start:start+length] = bytes([key])*length
             
+        self.writable = None
+        self.updatePages(start, length)
+
 
         # Process memory values.
         if type(value) == list:
-            for i in range(len(value)):
-                self.memory[start+i+valueOffset] = value[i]
+            offset = start + valueOffset
+            self.memory[offset:offset+len(value)] = bytes(value)
+
+        elif hasattr(value, "readinto"):
+            offset = start + valueOffset
+            value.readinto(memoryview(self.memory)[offset:start+length])
 
         elif value is not None:
-            data = value.read().split()
-            for i in range(len(data)):
-                self.memory[start+i+valueOffset] = int(data[i], 16)
+            data = bytes(int(x, 16) for x in value.read().split())
+            offset = start + valueOffset
+            self.memory[offset:offset+len(data)] = data
 
 
     def write(self, addr, value):
         """
         Write a value to the given address if it is writeable.
         """
-        if self.memmap[addr] != 0:
-            callback = self.callbacks[self.memmap[addr]]
-            callback(addr, value & 0xff)
-        else:
-            self.memory[addr] = value & 0xff
+        self.writers[addr >> 8](addr, value & 0xff)
 
     def read(self, addr):
         """
         Return the value at the address.
         """
+        return self.readers[addr >> 8](addr)
+
+    def slowWrite(self, addr, value):
+        if self.memmap[addr] != 0:
+            callback = self.callbacks[self.memmap[addr]]
+            callback(addr, value)
+        else:
+            self.memory[addr] = value
+        if self.tracked[addr >> 8]:
+            self.dirty.add(addr)
+
+    def slowRead(self, addr):
         if self.memmap[addr] != 0:
             return self.callbacks[self.memmap[addr]](addr, None)
         else:
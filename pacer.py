@@ -0,0 +1,69 @@
+import time
+
+# Keep the emulated machine running at the speed of a real Challenger 1P.
+#
+# After each frame the emulator hands over the total number of CPU cycles
+# run. The pacer works out when those cycles would have finished on the
+# real machine and sleeps until then. In turbo mode there is no sleeping and
+# frames are only drawn as often as the display refresh rate, so the CPU
+# gets nearly all of the host's time.
+#
+class Pacer:
+
+    # If the emulator falls further behind than this (a slow host or a
+    # popup dialog) don't try to catch up, just carry on from now.
+    MAX_LAG = 0.25
+
+    def __init__(self, clock, frame_rate):
+        self.clock = clock
+        self.frame_time = 1.0 / frame_rate
+        self.turbo = False
+        self.start_time = None
+        self.start_cycles = 0
+        self.last_frame = 0
+
+    def sync(self, cycles):
+        """
+        Start timing again from now and the given cycle count.
+        """
+        self.start_time = time.perf_counter()
+        self.start_cycles = cycles
+
+    def toggleTurbo(self, cycles):
+        self.turbo = not self.turbo
+        self.sync(cycles)
+
+    def frameDue(self):
+        """
+        Returns True if a frame should be drawn now. In turbo mode frames
+        are only drawn as often as the display refresh rate.
+        """
+        if not self.turbo:
+            return True
+        now = time.perf_counter()
+        if now - self.last_frame < self.frame_time:
+            return False
+        self.last_frame = now
+        return True
+
+    def pace(self, cycles, wakeup=None):
+        """
+        Called once per frame with the total number of CPU cycles run.
+        Sleeps until real time has caught up with the emulated time.  If
+        `wakeup`, a threading.Event, is given the sleep ends early when it is
+        set and the time is made up on the following frames.
+        """
+        if self.turbo:
+            return
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.sync(cycles)
+
+        target = self.start_time + (cycles - self.start_cycles) / self.clock
+        if now < target:
+            if wakeup is None:
+                time.sleep(target - now)
+            else:
+                wakeup.wait(target - now)
+        elif now - target > self.MAX_LAG:
+            self.sync(cycles)
@@ -0,0 +1,167 @@
+import struct
+import zlib
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+# A snapshot of the whole machine in a small binary file, so it can be put
+# back later exactly as it was.  Only the RAM is saved, the ROMs are checked
+# by their hash instead.  All values are little endian:
+#
+#     8 bytes   "C1PSNAP" and a 0
+#     2 bytes   format version
+#    20 bytes   SHA-1 of the ROMs, see `Machine.rom_hash`
+#     2 bytes   characters per video row, 32 or 64 for cwmhigh
+#     2 bytes   size of the video memory
+#     1 byte    length of the monitor ROM file name, then the name
+#     8 bytes   A, X, Y, S, PC (2 bytes) and P, then 8 bytes of total cycles
+#     9 bytes   the keyboard matrix and the last byte written to it
+#     1 byte    length of the tape file name (0 if none), then the name
+#     4 bytes   position in the tape, then 1 byte of ACIA status
+#     2 bytes   number of RAM ranges, then 4 bytes start and 4 bytes end of each
+#     the rest  the RAM ranges one after another, compressed with zlib
+#
+class Snapshot:
+
+    MAGIC = b"C1PSNAP\0"
+    VERSION = 1
+
+    HEADER = struct.Struct("<8sH20sHHB")
+    CPU = struct.Struct("<BBBBHBQ")
+    KEYBOARD = struct.Struct("<8sB")
+    TAPE = struct.Struct("<IB")
+    COUNT = struct.Struct("<H")
+    RANGE = struct.Struct("<II")
+
+    @classmethod
+    def save(cls, machine, filename):
+        """
+        Write a snapshot of the machine to the file.
+        """
+        cpu = machine.cpu
+        r = cpu.r
+        keyboard = machine.keyboard
+        cassette = machine.cassette
+        memory = machine.mmu.memory
+        monitor = machine.path.encode()
+        tape = (cassette.load_filename or "").encode()
+        ranges = machine.mmu.writableRanges()
+
+        data = bytearray()
+        data += cls.HEADER.pack(cls.MAGIC, cls.VERSION, machine.rom_hash(),
+                                machine.VIDEO_ROW_SIZE, machine.VIDEO_MEMORY_SIZE, len(monitor))
+        data += monitor
+        data += cls.CPU.pack(r.a, r.x, r.y, r.s, r.pc, r.p, cpu.cycles)
+        data += cls.KEYBOARD.pack(bytes(keyboard.matrix), keyboard.kbport)
+        data.append(len(tape))
+        data += tape
+        data += cls.TAPE.pack(cassette.load_index, cassette.acia_status)
+        data += cls.COUNT.pack(len(ranges))
+        for start, end in ranges:
+            data += cls.RANGE.pack(start, end)
+        data += zlib.compress(b"".join(memory[start:end] for start, end in ranges), 1)
+
+        with open(filename, "wb") as f:
+            f.write(data)
+
+    @classmethod
+    def readHeader(cls, data):
+        """
+        Check the start of a snapshot and return its header fields, the
+        monitor name and the offset after them.
+        """
+        if len(data) < cls.HEADER.size:
+            raise SnapshotError("not a snapshot")
+        magic, version, rom_hash, row_size, video_size, length = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise SnapshotError("not a snapshot")
+        if version != cls.VERSION:
+            raise SnapshotError("snapshot version %d is not supported" % version)
+        offset = cls.HEADER.size
+        try:
+            monitor = data[offset:offset+length].decode()
+        except UnicodeDecodeError:
+            raise SnapshotError("snapshot is damaged")
+        return rom_hash, row_size, video_size, monitor, offset + length
+
+    @classmethod
+    def monitor(cls, filename):
+        """
+        Return the name of the monitor ROM the snapshot was taken with.
+        """
+        with open(filename, "rb") as f:
+            data = f.read(cls.HEADER.size + 255)
+        return cls.readHeader(data)[3]
+
+    @classmethod
+    def restore(cls, machine, filename):
+        """
+        Put the machine back the way it was when the snapshot was saved.
+        The machine must have the same ROMs and display.
+        """
+        with open(filename, "rb") as f:
+            data = f.read()
+        rom_hash, row_size, video_size, monitor, offset = cls.readHeader(data)
+        if rom_hash != machine.rom_hash():
+            raise SnapshotError("snapshot was taken with different ROMs (%s)" % monitor)
+        if (row_size, video_size) != (machine.VIDEO_ROW_SIZE, machine.VIDEO_MEMORY_SIZE):
+            raise SnapshotError("snapshot was taken with a different display")
+
+        try:
+            a, x, y, s, pc, p, cycles = cls.CPU.unpack_from(data, offset)
+            offset += cls.CPU.size
+            matrix, kbport = cls.KEYBOARD.unpack_from(data, offset)
+            offset += cls.KEYBOARD.size
+            length = data[offset]
+            tape = data[offset+1:offset+1+length].decode()
+            offset += 1 + length
+            position, acia_status = cls.TAPE.unpack_from(data, offset)
+            offset += cls.TAPE.size
+            count, = cls.COUNT.unpack_from(data, offset)
+            offset += cls.COUNT.size
+            ranges = []
+            for i in range(count):
+                ranges.append(cls.RANGE.unpack_from(data, offset))
+                offset += cls.RANGE.size
+            ram = zlib.decompress(data[offset:])
+        except (struct.error, IndexError, UnicodeDecodeError, zlib.error):
+            raise SnapshotError("snapshot is damaged")
+        if ranges != machine.mmu.writableRanges() or len(ram) != sum(end - start for start, end in ranges):
+            raise SnapshotError("snapshot was taken with a different memory map")
+
+        # Translated code belongs to the old RAM.
+        cpu = machine.cpu
+        cpu.flushBlocks()
+        memory = machine.mmu.memory
+        offset = 0
+        for start, end in ranges:
+            memory[start:end] = ram[offset:offset+end-start]
+            offset += end - start
+        machine.mmu.touchTracked()
+
+        r = cpu.r
+        r.a, r.x, r.y, r.s, r.pc, r.p = a, x, y, s, pc, p
+        cpu.cycles = cycles
+
+        keyboard = machine.keyboard
+        keyboard.cancelType()
+        keyboard.matrix[:] = matrix
+        keyboard.kbport = kbport
+        keyboard.buildScan()
+
+        cassette = machine.cassette
+        cassette.close()
+        cassette.eject()
+        if tape:
+            try:
+                cassette.load(tape)
+                cassette.rewind(position)
+                cassette.acia_status = acia_status
+            except OSError:
+                # The tape has gone, carry on without it.
+                cassette.eject()
+
+        machine.idle_frames = 0
+        machine.idle_memory = None
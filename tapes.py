@@ -0,0 +1,89 @@
+import bisect
+import json
+import os
+from cassette import Cassette
+
+# An index of the .bas and .mon files in the tape folder for the load
+# popup.  Each file has its size, modification time and a title taken from
+# its first REM line.  The index is kept in a file in the folder and only
+# the files that are new or have changed since it was written are read
+# again, so a folder of thousands of tapes opens straight away.
+#
+class TapeLibrary:
+
+    INDEX_FILE = ".index.json"
+    EXTENSIONS = (".bas", ".mon")
+
+    # How much of the start of a file to search for the title.
+    TITLE_SEARCH = 4096
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = {}
+        self.names = []
+        self.keys = []
+        try:
+            with open(os.path.join(folder, self.INDEX_FILE)) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def readTitle(self, path):
+        """
+        Return the text of the first REM line near the start of the file,
+        or "" if there isn't one.
+        """
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(self.TITLE_SEARCH)
+        except OSError:
+            return ""
+        for line in Cassette.TAPE_LINE.finditer(head):
+            if line.group(2):
+                title = Cassette.title(line.group(3))
+                if title:
+                    return title
+        return ""
+
+    def refresh(self):
+        """
+        Bring the index up to date with the folder, reading the titles of
+        new or changed files, and save it if anything changed.
+        """
+        entries = {}
+        changed = False
+        with os.scandir(self.folder) as files:
+            for file in files:
+                if not file.name.lower().endswith(self.EXTENSIONS) or not file.is_file():
+                    continue
+                stat = file.stat()
+                entry = self.entries.get(file.name)
+                if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                    entry = {"size": stat.st_size, "mtime": stat.st_mtime,
+                             "title": self.readTitle(file.path)}
+                    changed = True
+                entries[file.name] = entry
+        changed = changed or len(entries) != len(self.entries)
+        self.entries = entries
+
+        # Keep the names in order for paging and finding.
+        self.names = sorted(entries, key=str.lower)
+        self.keys = [name.lower() for name in self.names]
+
+        if changed:
+            try:
+                with open(os.path.join(self.folder, self.INDEX_FILE), "w") as f:
+                    json.dump(entries, f)
+            except OSError:
+                # A read only folder just means the titles are read again.
+                pass
+
+    def title(self, name):
+        return self.entries[name]["title"]
+
+    def find(self, prefix):
+        """
+        Return the index of the first name starting with the prefix, or of
+        the name it would come before.
+        """
+        return min(bisect.bisect_left(self.keys, prefix.lower()), max(len(self.names)-1, 0))
@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from machine import Machine
+
+
+class BasicTest(unittest.TestCase):
+    """
+    Put the same program into BASIC by typing it in through the keyboard
+    and with `Basic.load`, and check the ROM and the tokenizer store the
+    same lines.  Then check `Basic.list` gives back a listing that loads
+    as the same program.
+    """
+
+    # Quotes, REM, DATA, ? for PRINT, spaces inside keywords and line
+    # numbers, keywords run together and inside names, and lines that are
+    # replaced or deleted.
+    PROGRAM = (b'10 REM A TEST, "OF" PRINT:GOTO\r'
+               b'20 ?"HELLO";:PRINT "FOR TO":X=1\r'
+               b'30 DATA 1,2,PRINT,"A:B",3:PRINT X\r'
+               b'40 F O R I = 1 T O 10:NEXT I\r'
+               b'5 0 IF X<>2 THEN 10\r'
+               b'60 A$="":B=ATN(1)*4:PRINT B;TAB(3);SQR(2)\r'
+               b'70 ON X GOTO 10,20:GOSUB 60:RETURN\r'
+               b'80 FORI=1TO3:?I:NEXT\r'
+               b'25 REM REPLACED\r'
+               b'25 DATA  SPACES , " Q "  ,END\r'
+               b'35 X\r'
+               b'35\r'
+               b'100 TOTAL=ATOTAL: LET ORX=1 \r')
+
+    # Frames run after the last key so the ROM has finished with it.
+    SETTLE_FRAMES = 10
+
+    def type_in(self, machine, text):
+        machine.keyboard.autoType(text)
+        while machine.keyboard.typing:
+            machine.run(machine.CYCLES_PER_FRAME)
+        machine.run(self.SETTLE_FRAMES * machine.CYCLES_PER_FRAME)
+
+    def basic(self):
+        # Cold start BASIC, taking the default memory size and width.
+        machine = Machine('cegmon.hex')
+        self.type_in(machine, 'C\r\r\r')
+        self.assertTrue(machine.basic.started())
+        return machine
+
+    def program(self, machine):
+        basic = machine.basic
+        return list(basic.lines()), basic.readWord(basic.VARTAB)
+
+    def test_tokenize(self):
+        typed = self.basic()
+        self.type_in(typed, self.PROGRAM)
+        self.assertEqual(len(list(typed.basic.lines())), 10)
+        loaded = self.basic()
+        self.assertEqual(loaded.basic.load(self.PROGRAM), 10)
+        self.assertEqual(self.program(loaded), self.program(typed))
+
+    def test_list(self):
+        machine = self.basic()
+        machine.basic.load(self.PROGRAM)
+        program = self.program(machine)
+        listing = machine.basic.list()
+        self.assertIn(b'20 PRINT"HELLO";', listing)
+        self.assertIn(b'40 FOR I = 1 TO 10:NEXT I\r\n', listing)
+        machine.basic.load(b'')
+        machine.basic.load(listing)
+        self.assertEqual(self.program(machine), program)
+
+    def test_not_started(self):
+        machine = Machine('cegmon.hex')
+        self.assertIsNone(machine.basic.load(self.PROGRAM))
+        self.assertIsNone(machine.basic.list())
+
+
+if __name__ == '__main__':
+    unittest.main()
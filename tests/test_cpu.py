@@ -0,0 +1,108 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cpu import CPU
+from machine import Machine
+from mmu import MMU
+
+
+class DecimalModeTest(unittest.TestCase):
+    """
+    The decimal mode ADC and SBC look their results up in tables.  Check
+    every accumulator, operand and carry against the arithmetic the tables
+    replaced, the new A and all of P.
+    """
+
+    def setUp(self):
+        self.cpu = CPU(MMU([(0, 65536)]), 0)
+
+    def adc(self, p, v1, v2):
+        # ADC as it was before the tables.
+        cpu = self.cpu
+        r = cpu.fromBCD(v1) + cpu.fromBCD(v2) + (p & 0x01)
+        a = cpu.toBCD(r % 100)
+        p = ((p & 0x3c) | (r > 99) | cpu.r.NZ[a]
+             | (((~(v1 ^ v2)) & (v1 ^ r) & 0x80) >> 1))
+        return a, p
+
+    def sbc(self, p, v1, v2):
+        # SBC as it was before the tables.
+        cpu = self.cpu
+        r = cpu.fromBCD(v1) - cpu.fromBCD(v2) - 1 + (p & 0x01)
+        a = cpu.toBCD(r % 100)
+        p = ((p & 0x3c) | (r >= 0) | cpu.r.NZ[a]
+             | (((v1 ^ v2) & (v1 ^ r) & 0x80) >> 1))
+        return a, p
+
+    def check(self, op, expected):
+        cpu = self.cpu
+        r = cpu.r
+        # Decimal mode with the other flags all clear and then all set, so
+        # both setting and clearing N, V, Z and C are seen.
+        for p in (0x28, 0x29, 0xee, 0xef):
+            for v1 in range(256):
+                for v2 in range(256):
+                    r.a = v1
+                    r.p = p
+                    op(v2)
+                    if (r.a, r.p) != expected(p, v1, v2):
+                        self.fail("p=%02x a=%02x operand=%02x gave a=%02x p=%02x, expected a=%02x p=%02x"
+                                  % ((p, v1, v2, r.a, r.p) + expected(p, v1, v2)))
+
+    def test_adc(self):
+        self.check(self.cpu.ADC, self.adc)
+
+    def test_sbc(self):
+        self.check(self.cpu.SBC, self.sbc)
+
+
+class CompiledTest(unittest.TestCase):
+    """
+    Boot the monitor into BASIC and run a program with each of the ways of
+    running code, the partials, the compiled handlers and the translated
+    blocks, and check they end up with the same registers and memory.
+    """
+
+    TEXT = ('C\r\r\r'
+            '10 A$="":FOR I=1 TO 20:A$=A$+CHR$(65+I):B=I*1.5/7:NEXT\r'
+            '20 PRINT A$;B;SQR(B)\r'
+            'RUN\r')
+
+    # Frames run after the text has been typed, long enough for the
+    # program to finish.
+    RUN_FRAMES = 30
+
+    def machine(self, compiled, translate):
+        machine = Machine('cegmon.hex', compiled=compiled, translate=translate)
+        machine.keyboard.autoType(self.TEXT)
+        return machine
+
+    def state(self, machine):
+        r = machine.cpu.r
+        return (r.a, r.x, r.y, r.s, r.pc, r.p, machine.cpu.cycles)
+
+    def test_modes(self):
+        partial = self.machine(False, False)
+        compiled = self.machine(True, False)
+        translated = self.machine(True, True)
+
+        # A translated block runs to its end so the other two are brought
+        # up to the same instruction after each frame.
+        frames = self.RUN_FRAMES
+        while frames:
+            if not translated.keyboard.typing:
+                frames -= 1
+            translated.run(translated.CYCLES_PER_FRAME)
+            for machine in (partial, compiled):
+                machine.run(translated.cpu.cycles - machine.cpu.cycles)
+                self.assertEqual(self.state(machine), self.state(translated))
+                self.assertEqual(machine.mmu.memory, translated.mmu.memory)
+
+        self.assertIn("BCDEFGHIJKLMNOPQRSTU", translated.video_text())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from keyboard import Keyboard
+
+
+class ScanTest(unittest.TestCase):
+    """
+    Reads of the keyboard are answered from a table kept up to date as keys
+    go up and down.  Check every row select byte, normal and inverted,
+    against walking the rows of the matrix the way the table replaced.
+    """
+
+    CHANGES = 200
+
+    def scan(self, keyboard, value):
+        # The read as it was before the table.
+        k = value ^ 0xff if keyboard.INVERT_KEY else value
+        b = 0xff
+        for i in range(len(keyboard.matrix)):
+            if k & 1 == 0:
+                b &= keyboard.matrix[i]
+            k >>= 1
+        return b ^ 0xff if keyboard.INVERT_KEY else b
+
+    def check(self, keyboard):
+        for value in range(256):
+            keyboard.callback(0xdf00, value)
+            self.assertEqual(keyboard.callback(0xdf00, None), self.scan(keyboard, value),
+                             "select %02x matrix %s" % (value, keyboard.matrix.hex()))
+
+    def run_changes(self, invert):
+        keyboard = Keyboard()
+        keyboard.setInvert(invert)
+        keys = sorted(keyboard.keys, key=str)
+        rnd = random.Random(21)
+        self.check(keyboard)
+        for i in range(self.CHANGES):
+            key = rnd.choice(keys)
+            if rnd.random() < 0.6:
+                keyboard.pressKey(key)
+            else:
+                keyboard.releaseKey(key)
+            self.check(keyboard)
+        keyboard.clearMatrix()
+        self.check(keyboard)
+
+    def test_normal(self):
+        self.run_changes(False)
+
+    def test_inverted(self):
+        self.run_changes(True)
+
+
+if __name__ == '__main__':
+    unittest.main()